@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""Офлайн-бенчмарк бота: без YouTube, прокси, OpenAI и Telegram.
+- OpenAI: локальный HTTP-сервер с /v1/chat/completions (обычный ответ и stream), задержка и доля ошибок настраиваются;
+  бот ходит в него настоящим AsyncOpenAI через OPENAI_BASE_URL.
+- YouTube: подменяется один запрос транскрипта (transcript.fetch_with_client) — задержка, блокировки по прокси,
+  «мёртвые» прокси, видео без субтитров. Хеджирование, пул прокси, кэш и всё выше работают как в проде.
+- Telegram: синтетические апдейты идут в bot.handle_message, ответы — в заглушки сообщений с задержкой API.
+Отчёт: пропускная способность, p50/p95/p99 и память для одиночной нагрузки и всплеска, плюс микробенчмарки
+оглавления и разбора транскрипта на многочасовых видео. Пример: python bench.py --requests 200 --users 20"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+from types import SimpleNamespace
+
+_tmp = tempfile.mkdtemp(prefix="ytbot-bench-")
+# До импорта модулей бота: свой кэш, фейковые ключи и прокси, без обновления прокси с веба
+os.environ.update({
+    "CACHE_DB": str(Path(_tmp) / "cache.sqlite3"),
+    "JOBS_DB": str(Path(_tmp) / "jobs.sqlite3"),
+    "CORPUS_DB": str(Path(_tmp) / "corpus.sqlite3"),
+    "OPENAI_API_KEY": "bench",
+    "PROXY_WEB_REFRESH_MINUTES": "0",
+    "JOB_QUEUE": "0",
+})
+
+WORDS = ("видео", "модель", "данные", "пример", "идея", "вопрос", "ответ", "система", "время", "задача",
+         "the", "model", "data", "example", "we", "going", "to", "look", "at", "this")
+
+
+def synthetic_snippets(minutes: float, seed: int = 0) -> list[tuple[float, str]]:
+    """Сниппеты как у автосубтитров: каждые ~3 с по 6–12 слов, иногда пауза."""
+    rnd = random.Random(seed)
+    out, t = [], 0.0
+    while t < minutes * 60:
+        out.append((round(t, 2), " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(6, 12)))))
+        t += rnd.uniform(2.0, 4.0) + (rnd.random() < 0.03) * rnd.uniform(3, 8)
+    return out
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса (Linux), иначе пик."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# --- Фейковый OpenAI ---
+
+class FakeOpenAI:
+    def __init__(self, latency: float, per_token: float, error_rate: float, seed: int):
+        self.latency = latency
+        self.per_token = per_token
+        self.error_rate = error_rate
+        self.rnd = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+    async def handle(self, headers: dict[str, str], body: bytes) -> tuple[int, str, bytes]:
+        self.requests += 1
+        req = json.loads(body)
+        max_tokens = req.get("max_tokens") or 500
+        await asyncio.sleep(self.latency * self.rnd.uniform(0.7, 1.3) + max_tokens * self.per_token)
+        if self.rnd.random() < self.error_rate:
+            self.errors += 1
+            return 500, "application/json", b'{"error": {"message": "fake overload", "type": "server_error"}}'
+        content = self._content(req)
+        usage = {"prompt_tokens": sum(len(m["content"]) for m in req["messages"]) // 3,
+                 "completion_tokens": len(content) // 3, "total_tokens": 0}
+        if req.get("stream"):
+            chunks = [content[i:i + 40] for i in range(0, len(content), 40)]
+            events = [{"id": "b", "object": "chat.completion.chunk", "created": 0, "model": req["model"],
+                       "choices": [{"index": 0, "delta": {"content": c}, "finish_reason": None}]} for c in chunks]
+            events.append({"id": "b", "object": "chat.completion.chunk", "created": 0, "model": req["model"],
+                           "choices": [], "usage": usage})
+            payload = "".join(f"data: {json.dumps(e, ensure_ascii=False)}\n\n" for e in events) + "data: [DONE]\n\n"
+            return 200, "text/event-stream", payload.encode("utf-8")
+        return 200, "application/json", json.dumps({
+            "id": "b", "object": "chat.completion", "created": 0, "model": req["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        }, ensure_ascii=False).encode("utf-8")
+
+    @staticmethod
+    def _content(req: dict) -> str:
+        system = req["messages"][0]["content"]
+        if req.get("response_format", {}).get("type") == "json_object":
+            n = system.count("---") + 20
+            return json.dumps({"toc": [f"Пункт {i + 1}" for i in range(n)], "summary": ["Первый абзац.", "Второй абзац."]})
+        if "оглавление" in system:
+            n = int(next((w for w in system.split() if w.isdigit()), "10"))
+            return "\n".join(f"Тема фрагмента {i + 1}" for i in range(n))
+        return "Синтетическая выжимка видео. " * 20 + "\n\n" + "Главные выводы. " * 20
+
+
+# --- Фейковый YouTube ---
+
+class FakeYouTube:
+    """Вместо transcript.fetch_with_client: поведение зависит от маршрута (прокси) и video_id."""
+
+    def __init__(self, latency: float, block_rate: float, dead_proxies: set[str], no_captions_rate: float,
+                 minutes: float, seed: int):
+        self.latency = latency
+        self.block_rate = block_rate
+        self.dead = dead_proxies
+        self.no_captions_rate = no_captions_rate
+        self.minutes = minutes
+        self.rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def fetch(self, api, video_id: str):
+        from youtube_transcript_api import RequestBlocked, TranscriptsDisabled
+
+        px = api._fetcher._http_client.proxies.get("https")
+        with self._lock:
+            self.calls += 1
+            jitter = self.rnd.uniform(0.5, 2.0)
+            blocked = self.rnd.random() < self.block_rate
+        if px in self.dead:
+            time.sleep(self.latency * 3)
+            raise RequestBlocked(video_id)
+        time.sleep(self.latency * jitter)
+        if blocked:
+            raise RequestBlocked(video_id)
+        if random.Random(video_id).random() < self.no_captions_rate:
+            raise TranscriptsDisabled(video_id)
+        snippets = synthetic_snippets(self.minutes, seed=zlib.crc32(video_id.encode()))
+        return SimpleNamespace(
+            snippets=[SimpleNamespace(start=s, text=t, duration=3.0) for s, t in snippets],
+            language_code="ru",
+        )
+
+
+# --- Синтетический Telegram ---
+
+class FakeMessage:
+    _ids = 0
+
+    def __init__(self, text: str, chat_id: int, api_latency: float):
+        FakeMessage._ids += 1
+        self.message_id = FakeMessage._ids
+        self.text = text
+        self.chat_id = chat_id
+        self.api_latency = api_latency
+        self.edits = 0
+
+    async def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        await asyncio.sleep(self.api_latency)
+        return FakeMessage(text, self.chat_id, self.api_latency)
+
+    async def edit_text(self, text: str, **kwargs) -> "FakeMessage":
+        await asyncio.sleep(self.api_latency)
+        self.text = text
+        self.edits += 1
+        return self
+
+
+def synthetic_update(user_id: int, video_id: str, api_latency: float):
+    msg = FakeMessage(f"https://youtu.be/{video_id}", chat_id=user_id, api_latency=api_latency)
+    return SimpleNamespace(message=msg, effective_user=SimpleNamespace(id=user_id), effective_chat=SimpleNamespace(id=user_id))
+
+
+def video_ids(n: int, hot_share: float, seed: int) -> list[str]:
+    """n ссылок; доля hot_share — повторы нескольких «популярных» видео (группа шлёт одно и то же)."""
+    rnd = random.Random(seed)
+    hot = [f"hot{i:08d}" for i in range(5)]
+    return [rnd.choice(hot) if rnd.random() < hot_share else f"v{seed:03d}{i:07d}" for i in range(n)]
+
+
+async def run_workload(bot, name: str, ids: list[str], users: int, concurrent: bool, mode: str, api_latency: float) -> dict:
+    contexts = {u: SimpleNamespace(user_data={"mode": mode, "paragraphs": 2}) for u in range(users)}
+    latencies: list[float] = []
+    rss_before = rss_mb()
+    peak = rss_before
+    stop = asyncio.Event()
+
+    async def sample_rss() -> None:
+        nonlocal peak
+        while not stop.is_set():
+            peak = max(peak, rss_mb())
+            await asyncio.sleep(0.05)
+
+    async def one(i: int, vid: str) -> None:
+        user = i % users
+        started = time.perf_counter()
+        await bot.handle_message(synthetic_update(user, vid, api_latency), contexts[user])
+        latencies.append(time.perf_counter() - started)
+
+    sampler = asyncio.create_task(sample_rss())
+    started = time.perf_counter()
+    if concurrent:
+        await asyncio.gather(*(one(i, vid) for i, vid in enumerate(ids)))
+    else:
+        for i, vid in enumerate(ids):
+            await one(i, vid)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await sampler
+    return {
+        "workload": name, "requests": len(ids), "seconds": round(elapsed, 2),
+        "throughput_rps": round(len(ids) / elapsed, 2) if elapsed else 0.0,
+        "p50": round(percentile(latencies, 50), 3), "p95": round(percentile(latencies, 95), 3),
+        "p99": round(percentile(latencies, 99), 3),
+        "rss_mb": round(rss_before, 1), "rss_peak_mb": round(peak, 1),
+    }
+
+
+def micro(label: str, fn, repeat: int = 5) -> dict:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return {"micro": label, "best_ms": round(min(times) * 1000, 2), "median_ms": round(statistics.median(times) * 1000, 2)}
+
+
+async def micro_benchmarks(hours: list[float]) -> list[dict]:
+    """Оглавление, разбор транскрипта и индекс /ask на длинных синтетических видео (LLM — фейковый сервер)."""
+    from cache import TranscriptCache
+    from compact import compact_snippets
+    from corpus import Corpus
+    from llm import count_tokens, split_snippets, CHUNK_TOKENS
+    from pipeline import build_toc_message
+    from toc import format_toc, toc_segments
+
+    out = []
+    cache = TranscriptCache(Path(_tmp) / "micro.sqlite3")
+    corpus = Corpus(Path(_tmp) / "micro_corpus.sqlite3")
+    for h in hours:
+        snippets = synthetic_snippets(h * 60, seed=int(h * 10))
+        raw = [SimpleNamespace(start=s, text=t) for s, t in snippets]
+        label = f"{h:g}h/{len(snippets)} сниппетов"
+        out.append(micro(f"разбор ответа API ({label})", lambda: [(x.start, x.text) for x in raw]))
+        out.append(micro(f"кэш put+get ({label})", lambda: (cache.put("micro", snippets, "ru"), cache.get("micro"))))
+        out.append(micro(f"compact_snippets ({label})", lambda: compact_snippets(snippets)))
+        out.append(micro(f"toc_segments ({label})", lambda: toc_segments(snippets)))
+        out.append(micro(f"индекс /ask, add_snippets ({label})", lambda: corpus.add_snippets(f"micro{h:g}", snippets)))
+        out.append(micro(f"поиск /ask, в индексе {corpus.stats()['chunks']} кусков", lambda: corpus.search("пример модели данных")))
+        segments = toc_segments(snippets)
+        out.append(micro(f"format_toc ({label})", lambda: format_toc(segments, [f"п{i}" for i in range(len(segments))], "abcdefghijk")))
+        out.append(micro(f"count_tokens+split_snippets ({label})",
+                         lambda: (count_tokens(" ".join(t for _, t in snippets)), split_snippets(snippets, CHUNK_TOKENS))))
+        started = time.perf_counter()
+        await build_toc_message(snippets, f"toc{int(h * 100):08d}")
+        out.append({"micro": f"build_toc_message, с фейковым LLM ({label})", "best_ms": round((time.perf_counter() - started) * 1000, 2)})
+    return out
+
+
+def startup_profile(module: str, top: int) -> list[dict]:
+    """Разбивка времени импорта (python -X importtime) в чистом процессе: самые дорогие модули по суммарному времени."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=Path(__file__).parent, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        capture_output=True, text=True, check=False,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        # «import time:   self [us] | cumulative | имя модуля» (первая строка — заголовок)
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = (x.strip() for x in line[len("import time:"):].split("|"))
+        rows.append({"startup": f"{module}: {name}", "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    rows.sort(key=lambda r: r["cumulative_ms"], reverse=True)
+    return rows[:top]
+
+
+async def amain(args) -> list[dict]:
+    from webserver import WebServer
+
+    openai = FakeOpenAI(args.openai_latency, args.openai_per_token, args.openai_error_rate, args.seed)
+    server = WebServer()
+    server.route("POST", "/v1/chat/completions", openai.handle)
+    await server.start(args.openai_port, host="127.0.0.1")
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.openai_port}/v1"
+
+    proxies = [f"http://10.255.0.{i}:8080" for i in range(1, args.proxies + 1)]
+    os.environ["YOUTUBE_PROXY"] = ",".join(proxies)
+    dead = set(random.Random(args.seed).sample(proxies, int(len(proxies) * args.dead_proxy_share)))
+    youtube = FakeYouTube(args.yt_latency, args.yt_block_rate, dead, args.no_captions_rate, args.video_minutes, args.seed)
+
+    import logging
+
+    import bot
+    import transcript
+    from llm import get_openai
+
+    logging.getLogger().setLevel(logging.ERROR)  # блокировки прокси тут — норма, не шумим
+    transcript.fetch_with_client = youtube.fetch
+    results = []
+    if args.startup:
+        for module in ("bot", "pipeline", "worker"):
+            results += startup_profile(module, args.startup_top)
+    importlib.import_module("pipeline")  # в проде — при прогреве, а не в первом запросе
+    if not args.skip_micro:
+        results += await micro_benchmarks(args.micro_hours)
+    n_single = max(1, args.requests // 10)
+    results.append(await run_workload(bot, "single", video_ids(n_single, 0.0, 1), 1, False, args.mode, args.telegram_latency))
+    results.append(await run_workload(bot, "burst", video_ids(args.requests, args.hot_share, 2), args.users, True, args.mode, args.telegram_latency))
+    results.append({"fake_openai_requests": openai.requests, "fake_openai_errors": openai.errors,
+                    "fake_youtube_calls": youtube.calls, "dead_proxies": len(dead)})
+    await get_openai().close()  # закрыть keep-alive до остановки сервера
+    await server.stop()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100, help="ссылок во всплеске (одиночная нагрузка — десятая часть)")
+    parser.add_argument("--users", type=int, default=10, help="пользователей во всплеске")
+    parser.add_argument("--mode", choices=("summary", "toc"), default="summary")
+    parser.add_argument("--hot-share", type=float, default=0.3, help="доля ссылок на одни и те же популярные видео")
+    parser.add_argument("--video-minutes", type=float, default=30, help="длина синтетических видео")
+    parser.add_argument("--proxies", type=int, default=10)
+    parser.add_argument("--dead-proxy-share", type=float, default=0.3, help="доля прокси, которые всегда блокируются")
+    parser.add_argument("--yt-latency", type=float, default=0.3, help="секунд на запрос транскрипта")
+    parser.add_argument("--yt-block-rate", type=float, default=0.1, help="вероятность блокировки живого прокси")
+    parser.add_argument("--no-captions-rate", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="задержка до ответа OpenAI, с")
+    parser.add_argument("--openai-per-token", type=float, default=0.0005, help="секунд на токен max_tokens")
+    parser.add_argument("--openai-error-rate", type=float, default=0.02)
+    parser.add_argument("--openai-port", type=int, default=18080)
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="задержка Bot API на отправку/правку")
+    parser.add_argument("--micro-hours", type=float, nargs="*", default=[1, 4, 10], help="длины видео для микробенчмарков")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--startup", action="store_true", help="показать, что сколько импортируется (bot, pipeline, worker)")
+    parser.add_argument("--startup-top", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="вывести результаты одной JSON-строкой на запись")
+    args = parser.parse_args()
+
+    results = asyncio.run(amain(args))
+    for r in results:
+        if args.json:
+            print(json.dumps(r, ensure_ascii=False))
+        elif "startup" in r:
+            print(f"{r['startup']:<60} {r['cumulative_ms']:>8.1f} мс (сам {r['self_ms']:.1f})")
+        elif "micro" in r:
+            print(f"{r['micro']:<60} {r['best_ms']:>10.2f} мс")
+        elif "workload" in r:
+            print(f"{r['workload']:<8} {r['requests']:>5} запросов за {r['seconds']:>7.2f} с  {r['throughput_rps']:>7.2f} rps  "
+                  f"p50 {r['p50']:.2f}  p95 {r['p95']:.2f}  p99 {r['p99']:.2f} с  RSS {r['rss_mb']:.0f}→{r['rss_peak_mb']:.0f} МБ")
+        else:
+            print(r)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
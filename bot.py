@@ -3,24 +3,31 @@
 Telegram-бот: на YouTube-ссылку отвечает кратким саммари (2 абзаца).
 Env: TELEGRAM_BOT_TOKEN, OPENAI_API_KEY. Опционально HTTP_PROXY/HTTPS_PROXY или proxy_working.txt.
 """
+import hmac
 import html
+import json
 import logging
 import os
 import re
-import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import signal
+import time
 from pathlib import Path
 
+from metrics import Gauge, install_trace_logging, metrics_handler, new_trace
+
 LOG_DIR = Path(__file__).parent
+install_trace_logging()
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    format="%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s",
     handlers=[
         logging.StreamHandler(),
         logging.FileHandler(LOG_DIR / "bot.log", encoding="utf-8"),
     ],
 )
 
+log = logging.getLogger(__name__)
+
 try:
     from dotenv import load_dotenv
     load_dotenv()
@@ -28,24 +35,48 @@ except ImportError:
     pass
 import asyncio
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import Application, MessageHandler, CommandHandler, filters, ContextTypes
 
-from transcript import fetch_transcript, fetch_transcript_timestamped
+from corpus import get_corpus
+from jobqueue import JobQueue
+from llm import DEFAULT_PARAGRAPHS, answer_question
+from persistence import SqlitePersistence
+from scheduler import FairScheduler, Overloaded
+from webserver import WebServer
 
 # Варианты количества абзацев выжимки
 PARAGRAPH_OPTIONS = (2, 4, 8, 10)
-DEFAULT_PARAGRAPHS = 2
 
 TOC_BUTTON = "Оглавление"
 
+# Сколько последних видео помнить на пользователя (/history)
+HISTORY_SIZE = 10
+
+# Сколько апдейтов Telegram обрабатывать одновременно (ожидание сети — в asyncio, не в потоках)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "256"))
+
+# Вебхук: если задан WEBHOOK_URL (публичный https-адрес приложения) — вместо polling.
+# WEBHOOK_SECRET (обязателен) сверяем с заголовком X-Telegram-Bot-Api-Secret-Token. Один на все экземпляры:
+# каждый регистрирует вебхук со своим секретом, и со случайным работал бы только последний
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Планировщик для обработки в этом процессе (без JOB_QUEUE): по кругу между пользователями, с лимитами
+scheduler = FairScheduler()
+BUSY_TEXT = "Сейчас очень много запросов. Попробуй через пару минут."
+# Больше стольких незавершённых задач в очереди воркеров — новые не принимаем
+JOB_MAX_BACKLOG = int(os.environ.get("JOB_MAX_BACKLOG", "500"))
+
+# JOB_QUEUE=1: бот только принимает ссылки и кладёт задачи в очередь, обрабатывают процессы worker.py
+job_queue = JobQueue() if os.environ.get("JOB_QUEUE", "0") == "1" else None
+
+
 def get_paragraphs_keyboard():
     keys = [[KeyboardButton(f"{n} абзац" + ("а" if 2 <= n <= 4 else "ов"))] for n in PARAGRAPH_OPTIONS]
     keys.append([KeyboardButton(TOC_BUTTON)])
     return ReplyKeyboardMarkup(keys, resize_keyboard=True, one_time_keyboard=False)
 
-# Лимит символов транскрипта для LLM (контекст)
-TRANSCRIPT_MAX_CHARS = 12_000
-
 # Паттерны YouTube: watch?v=, youtu.be/, embed/
 YOUTUBE_PATTERN = re.compile(
     r"(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/)([A-Za-z0-9_-]{11})"
@@ -67,112 +98,11 @@ def _parse_paragraphs_button(text: str) -> int | None:
     return None
 
 
-def summarize_with_openai(transcript_text: str, num_paragraphs: int = DEFAULT_PARAGRAPHS) -> str:
-    """Саммари на num_paragraphs абзацев через OpenAI."""
-    from openai import OpenAI
-
-    key = os.environ.get("OPENAI_API_KEY")
-    if not key:
-        return "Не задан OPENAI_API_KEY."
-    client = OpenAI(api_key=key)
-    if len(transcript_text) > TRANSCRIPT_MAX_CHARS:
-        transcript_text = transcript_text[:TRANSCRIPT_MAX_CHARS] + "\n[... обрезано ...]"
-    num_str = str(num_paragraphs)
-    parts = ["О чём видео, основная тема.", "Главные выводы, советы или идеи."]
-    for i in range(3, num_paragraphs + 1):
-        parts.append("Дополнительные важные моменты.")
-    prompt = f"""Кратко суммаризуй содержание видео по транскрипту. Ответ строго в {num_str} абзацев:
-""" + "\n".join(f"{i}) {parts[i-1]}" for i in range(1, num_paragraphs + 1)) + """
-
-Транскрипт:
-"""
-    try:
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": f"Ты делаешь краткие выжимки видео. Пиши только {num_str} абзаца(ов), без заголовков и списков."},
-                {"role": "user", "content": prompt + transcript_text},
-            ],
-            max_tokens=min(500 + (num_paragraphs - 2) * 150, 1000),
-        )
-        return (r.choices[0].message.content or "").strip()
-    except Exception as e:
-        return f"Ошибка саммари: {e!s}"
-
-
-TOC_SEGMENTS = 10
-
-
-def _sec_to_mmss(sec: float) -> str:
-    m = int(sec // 60)
-    s = int(sec % 60)
-    return f"{m}:{s:02d}"
-
-
-def make_toc_with_openai(segments: list[tuple[float, str]]) -> list[str]:
-    """По 10 сегментам (start_sec, text) вернуть 10 строк — краткое описание каждого (без таймкода)."""
-    from openai import OpenAI
-
-    key = os.environ.get("OPENAI_API_KEY")
-    if not key:
-        return [f"Не задан OPENAI_API_KEY."] * len(segments)
-    client = OpenAI(api_key=key)
-    parts = []
-    for start, text in segments:
-        chunk = (text[:1500] + "...") if len(text) > 1500 else text
-        parts.append(chunk)
-    prompt = """По транскрипту ниже даны 10 фрагментов видео по порядку.
-Для каждого фрагмента напиши одну короткую строку (3–10 слов) — о чём речь.
-Только 10 строк, по одной на фрагмент, в том же порядке. Без нумерации, без таймкодов.
-
-""" + "\n\n---\n\n".join(parts)
-    try:
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Ты составляешь оглавление видео. Ответ: 10 строк, только описание каждого фрагмента."},
-                {"role": "user", "content": prompt},
-            ],
-            max_tokens=800,
-        )
-        raw = (r.choices[0].message.content or "").strip()
-        lines = [ln.strip() for ln in raw.split("\n") if ln.strip()][: len(segments)]
-        while len(lines) < len(segments):
-            lines.append("—")
-        return lines[: len(segments)]
-    except Exception as e:
-        return [f"Ошибка оглавления: {e!s}"]
-
-
-def build_toc_message(snippets: list[tuple[float, str]], video_id: str) -> str:
-    """По списку (start_sec, text) и video_id собрать HTML-сообщение с оглавлением (кликабельные ссылки)."""
-    if not snippets:
-        return ""
-    duration = snippets[-1][0] + 30
-    seg_len = max(duration / TOC_SEGMENTS, 1)
-    segments: list[tuple[float, str]] = []
-    for i in range(TOC_SEGMENTS):
-        t_start = i * seg_len
-        t_end = (i + 1) * seg_len
-        texts = [s[1] for s in snippets if t_start <= s[0] < t_end]
-        if not texts and segments:
-            t_start = segments[-1][0]
-        start_sec = t_start if texts else (t_start + t_end) / 2
-        segments.append((start_sec, " ".join(texts) if texts else "(нет речи)"))
-    descriptions = make_toc_with_openai(segments)
-    toc_lines = []
-    for (start_sec, _), desc in zip(segments, descriptions):
-        url = f"https://www.youtube.com/watch?v={video_id}&t={int(start_sec)}"
-        label = f"{_sec_to_mmss(start_sec)} — {desc}"
-        toc_lines.append(f'<a href="{html.escape(url)}">{html.escape(label)}</a>')
-    return "\n".join(toc_lines)
-
-
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показать меню и текущую настройку."""
     mode = context.user_data.get("mode", "summary")
     if mode == "toc":
-        msg = "Сейчас режим: Оглавление (10 пунктов с таймкодами)."
+        msg = "Сейчас режим: Оглавление (10–20 пунктов с таймкодами, по длине видео)."
     else:
         n = context.user_data.get("paragraphs", DEFAULT_PARAGRAPHS)
         msg = f"Сейчас выжимка: {n} абзац(а/ов)."
@@ -185,7 +115,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def cmd_toc(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Режим «Оглавление» — то же, что кнопка."""
     context.user_data["mode"] = "toc"
-    await update.message.reply_text("Режим: Оглавление (~10 пунктов с таймкодами). Пришли ссылку на YouTube.")
+    await update.message.reply_text("Режим: Оглавление (10–20 пунктов с таймкодами, по длине видео). Пришли ссылку на YouTube.")
 
 
 async def cmd_summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -198,6 +128,68 @@ async def cmd_summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     )
 
 
+async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Последние присланные видео."""
+    history = context.user_data.get("history", [])
+    if not history:
+        await update.message.reply_text("Пока пусто — пришли ссылку на YouTube.")
+        return
+    lines = [
+        f"{time.strftime('%d.%m %H:%M', time.localtime(ts))} {'оглавление' if mode == 'toc' else 'выжимка'}: https://youtu.be/{vid}"
+        for vid, mode, ts in reversed(history)
+    ]
+    await update.message.reply_text("Последние видео:\n" + "\n".join(lines), disable_web_page_preview=True)
+
+
+async def cmd_ask(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/ask вопрос — ответ по корпусу транскриптов: ищем подходящие куски и отвечаем по ним со ссылками на моменты."""
+    question = " ".join(context.args or []).strip()
+    if not question:
+        await update.message.reply_text("Напиши вопрос после команды, например: /ask как выбрать прокси?")
+        return
+    new_trace()
+    hits = await asyncio.to_thread(get_corpus().search, question)
+    log.info("ask: %d кусков из %d видео", len(hits), len({h.video_id for h in hits}))
+    if not hits:
+        await update.message.reply_text("В транскриптах ничего похожего не нашлось.")
+        return
+    answer = await answer_question(question, [h.text for h in hits])
+    sources = "\n".join(f'[{i}] <a href="{html.escape(h.url)}">{html.escape(h.label)}</a>' for i, h in enumerate(hits, 1))
+    await update.message.reply_text(
+        html.escape(answer) + "\n\n" + sources, parse_mode="HTML", disable_web_page_preview=True
+    )
+
+
+async def _process_scheduled(update: Update, user_id: int, video_id: str, mode: str, num_paragraphs: int) -> None:
+    """Обработка в этом процессе через справедливый планировщик; пока ждём — правим сообщение с местом в очереди."""
+    # Тяжёлый импорт (requests, youtube_transcript_api): к этому моменту уже сделан в warm-up, в режиме очереди не нужен
+    from pipeline import process_video
+
+    status = None
+
+    async def on_position(ahead: int) -> None:
+        nonlocal status
+        text = f"В очереди, перед тобой: {ahead}."
+        if status is None:
+            status = await update.message.reply_text(text)
+        else:
+            await status.edit_text(text)
+
+    async def work() -> None:
+        if status is not None:
+            try:
+                await status.edit_text("Очередь подошла, начинаю.")
+            except TelegramError:
+                pass
+        await process_video(update.message.reply_text, video_id, mode, num_paragraphs)
+
+    try:
+        await scheduler.run(user_id, work, on_position)
+    except Overloaded as e:
+        log.warning("scheduler: отказ %s (%s), %s", user_id, e.reason, scheduler.stats())
+        await update.message.reply_text(BUSY_TEXT if e.reason == "slo" else "У тебя уже много ссылок в очереди — дождись ответа на них.")
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.message.text:
         return
@@ -206,7 +198,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Режим «Оглавление»
     if text.strip() == TOC_BUTTON:
         context.user_data["mode"] = "toc"
-        await update.message.reply_text("Готово. Режим: Оглавление (~10 пунктов с таймкодами). Пришли ссылку на YouTube.")
+        await update.message.reply_text("Готово. Режим: Оглавление (10–20 пунктов с таймкодами, по длине видео). Пришли ссылку на YouTube.")
         return
 
     # Выбор количества абзацев
@@ -222,97 +214,147 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Пришли ссылку на YouTube (youtube.com или youtu.be) или выбери режим кнопкой.")
         return
 
+    new_trace()
     mode = context.user_data.get("mode", "summary")
-    loop = asyncio.get_event_loop()
-
-    if mode == "toc":
-        await update.message.reply_text("Скачиваю субтитры и делаю оглавление…")
-        try:
-            result = await asyncio.wait_for(
-                loop.run_in_executor(None, fetch_transcript_timestamped, video_id),
-                timeout=90.0,
-            )
-        except asyncio.TimeoutError:
-            await update.message.reply_text("Запрос к YouTube занял слишком много времени. Попробуй ещё раз или другую ссылку.")
-            return
-        snippets, err_msg = result
-        if not snippets:
-            msg = "У этого видео нет субтитров или они недоступны."
-            if err_msg:
-                msg += f"\n\nПричина: {err_msg}"
-            await update.message.reply_text(msg)
-            return
-        toc_message = await loop.run_in_executor(None, build_toc_message, snippets, video_id)
-        await update.message.reply_text(toc_message, parse_mode="HTML")
-        return
-
-    # Режим выжимки (2/4/8/10): сначала оглавление, потом выжимка
     num_paragraphs = context.user_data.get("paragraphs", DEFAULT_PARAGRAPHS)
-    await update.message.reply_text("Скачиваю субтитры, делаю оглавление и выжимку…")
-    try:
-        result = await asyncio.wait_for(
-            loop.run_in_executor(None, fetch_transcript_timestamped, video_id),
-            timeout=90.0,
-        )
-    except asyncio.TimeoutError:
-        await update.message.reply_text("Запрос к YouTube занял слишком много времени. Попробуй ещё раз или другую ссылку.")
+    user_id = update.effective_user.id if update.effective_user else update.message.chat_id
+    history = context.user_data.setdefault("history", [])
+    history.append([video_id, mode, int(time.time())])
+    del history[:-HISTORY_SIZE]
+    if job_queue is None:
+        await _process_scheduled(update, user_id, video_id, mode, num_paragraphs)
         return
-    snippets, err_msg = result
-    if not snippets:
-        msg = "У этого видео нет субтитров или они недоступны."
-        if err_msg:
-            msg += f"\n\nПричина: {err_msg}"
-        await update.message.reply_text(msg)
+    # Тонкий фронтенд: настройки пользователя едут в задаче, работу делает worker.py
+    if await asyncio.to_thread(job_queue.pending) >= JOB_MAX_BACKLOG:
+        await update.message.reply_text(BUSY_TEXT)
         return
-    transcript_text = " ".join(s[1] for s in snippets)
-    toc_message = await loop.run_in_executor(None, build_toc_message, snippets, video_id)
-    summary = await loop.run_in_executor(
-        None, summarize_with_openai, transcript_text, num_paragraphs
+    job_id = await asyncio.to_thread(
+        job_queue.enqueue, update.message.chat_id, video_id, mode, num_paragraphs,
+        update.message.message_id, user_id,
     )
-    await update.message.reply_text(toc_message, parse_mode="HTML")
-    await update.message.reply_text("———\n\n" + summary)
+    ahead = await asyncio.to_thread(job_queue.position, job_id)
+    await update.message.reply_text("Принято, начинаю…" if ahead == 0 else f"Принято, в очереди перед тобой: {ahead}.")
+
 
+# Общий HTTP-сервер на PORT: /health для Fly.io, в режиме вебхука — ещё и апдейты Telegram
+web = WebServer()
 
-def _run_health_server(port: int) -> None:
-    """Сервер для Fly.io health check на 0.0.0.0:port."""
-    class Handler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.end_headers()
-        def log_message(self, *args):
-            pass
-    server = HTTPServer(("0.0.0.0", port), Handler)
-    server.serve_forever()
+
+# Фоновая досинхронизация индекса /ask при старте (держим ссылку, чтобы задачу не собрал GC)
+_corpus_sync: asyncio.Task | None = None
+
+# Готов ли бот: до конца прогрева /health отвечает 503, чтобы платформа не слала трафик раньше времени
+ready = False
+
+
+async def _health(headers: dict[str, str], body: bytes) -> tuple[int, str, bytes]:
+    if not ready:
+        return 503, "text/plain", b"starting"
+    return 200, "text/plain", b"ok"
+
+
+web.route("GET", "/", _health)
+web.route("GET", "/health", _health)
+web.route("GET", "/metrics", metrics_handler)
+Gauge("scheduler_active", "Видео в обработке (планировщик этого процесса)", lambda: scheduler.stats()["active"])
+Gauge("scheduler_queued", "Видео в очереди планировщика", lambda: scheduler.stats()["queued"])
+if job_queue is not None:
+    Gauge("jobs_pending", "Незавершённые задачи в очереди воркеров", job_queue.pending)
+
+
+def _webhook_handler(app: Application, secret: str):
+    async def handle(headers: dict[str, str], body: bytes) -> tuple[int, str, bytes]:
+        if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), secret):
+            return 401, "text/plain", b"bad secret"
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except ValueError:
+            return 400, "text/plain", b"bad json"
+        # Отвечаем сразу; обработка — в очереди PTB, параллельно (concurrent_updates)
+        await app.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+    return handle
 
 
 async def post_init(app: Application) -> None:
-    """Меню-полоска: команды при нажатии на имя бота / иконку меню."""
+    """Меню-полоска: команды при нажатии на имя бота / иконку меню. Поднять HTTP-сервер на PORT и прогреться."""
     await app.bot.set_my_commands([
         ("start", "Меню"),
-        ("toc", "Оглавление (10 пунктов)"),
+        ("toc", "Оглавление (10–20 пунктов)"),
         ("summary", "Выжимка (2/4/8/10 абзацев)"),
+        ("history", "Последние видео"),
+        ("ask", "Вопрос по всем транскриптам"),
     ])
+    global ready, _corpus_sync
+    port = os.environ.get("PORT")
+    if port:
+        await web.start(int(port))
+    # Досмотреть корпус для /ask (новые .txt, транскрипты из кэша) — в фоне, старт не ждёт
+    _corpus_sync = asyncio.create_task(asyncio.to_thread(get_corpus().sync))
+    if job_queue is None:
+        started = time.monotonic()
+        from pipeline import warm_up
+
+        log.info("startup: pipeline импортирован за %.2f с", time.monotonic() - started)
+        await warm_up()
+    ready = True
+
+
+async def post_shutdown(app: Application) -> None:
+    await web.stop()
+
+
+async def _run_webhook(app: Application, url: str, secret: str) -> None:
+    """Вебхук: Telegram шлёт апдейты POST-ом на WEBHOOK_URL/WEBHOOK_PATH, тот же сервер отвечает на /health."""
+    web.route("POST", WEBHOOK_PATH, _webhook_handler(app, secret))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with app:
+        await post_init(app)
+        await app.start()
+        await app.bot.set_webhook(
+            url=url.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        log.info("webhook: %s", url.rstrip("/") + WEBHOOK_PATH)
+        await stop.wait()
+        await app.stop()
+        await post_shutdown(app)
 
 
 def main() -> None:
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     if not token:
         raise SystemExit("Задай TELEGRAM_BOT_TOKEN в окружении.")
-    port = os.environ.get("PORT")
-    if port:
-        t = threading.Thread(target=_run_health_server, args=(int(port),), daemon=True)
-        t.start()
-    app = (
+    webhook_url = os.environ.get("WEBHOOK_URL")
+    builder = (
         Application.builder()
         .token(token)
-        .post_init(post_init)
-        .build()
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .persistence(SqlitePersistence())
     )
+    if not webhook_url:
+        builder = builder.post_init(post_init).post_shutdown(post_shutdown)
+    app = builder.build()
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("toc", cmd_toc))
     app.add_handler(CommandHandler("summary", cmd_summary))
+    app.add_handler(CommandHandler("history", cmd_history))
+    app.add_handler(CommandHandler("ask", cmd_ask))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if webhook_url:
+        if not os.environ.get("PORT"):
+            raise SystemExit("Для вебхука нужен PORT.")
+        secret = os.environ.get("WEBHOOK_SECRET")
+        if not secret:
+            raise SystemExit("Для вебхука нужен WEBHOOK_SECRET (один на все экземпляры бота).")
+        asyncio.run(_run_webhook(app, webhook_url, secret))
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
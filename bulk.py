@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Пакетная обработка: плейлист, канал или файл с video_id → транскрипты параллельно → оглавления и выжимки пакетом.
+Запросы к LLM собираются в JSONL в формате OpenAI Batch API. По умолчанию его выполняет локальная замена
+(общий AsyncOpenAI под OPENAI_CONCURRENCY), с --openai-batch — настоящий Batch API (дешевле, ответ до 24 ч).
+Длинные видео (map-reduce) в пакет не попадают — для них обычный путь summarize_snippets.
+Результаты дописываются в bulk_output.jsonl.gz и кладутся в кэш ответов: бот потом отвечает по этим видео без запроса к OpenAI."""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import re
+import sys
+import time
+from pathlib import Path
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+from cache import get_result_cache
+from compact import maybe_compact
+from llm import (
+    DEFAULT_PARAGRAPHS,
+    SINGLE_PASS_TOKENS,
+    complete_body,
+    count_tokens,
+    get_openai,
+    parse_toc_lines,
+    summarize_snippets,
+    summary_body,
+    summary_key,
+    toc_body,
+    toc_key,
+)
+from toc import toc_segments
+from transcript import fetch_transcript_timestamped_async, proxy_pool, session_for
+
+BASE = Path(__file__).parent
+BATCH_FILE = BASE / "bulk_batch.jsonl"
+OUTPUT_FILE = BASE / "bulk_output.jsonl.gz"
+BATCH_POLL_SEC = 60
+
+VIDEO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+PLAYLIST_PATTERN = re.compile(r"[?&]list=([A-Za-z0-9_-]+)")
+CHANNEL_PATTERN = re.compile(r"youtube\.com/(@[\w.-]+|channel/UC[\w-]{22}|c/[\w.-]+|user/[\w.-]+)")
+# Страница отдаёт первую порцию (~30 видео канала, ~100 плейлиста), остальное — по токенам продолжения innertube
+PAGE_VIDEO_ID = re.compile(r'"videoId":\s*"([A-Za-z0-9_-]{11})"')
+INNERTUBE_KEY = re.compile(r'"INNERTUBE_API_KEY":\s*"([^"]+)"')
+INNERTUBE_VERSION = re.compile(r'"INNERTUBE_CLIENT_VERSION":\s*"([^"]+)"')
+CONTINUATION_TOKEN = re.compile(r'"continuationItemRenderer":\s*\{.*?"token":\s*"([^"]+)"', re.S)
+MAX_CONTINUATIONS = 500
+
+log = logging.getLogger(__name__)
+
+
+def extract_playlist_id(text: str) -> str | None:
+    m = PLAYLIST_PATTERN.search(text)
+    return m.group(1) if m else None
+
+
+def extract_channel_path(text: str) -> str | None:
+    """«@handle», «channel/UC…», «c/…» или «user/…» из ссылки на канал."""
+    m = CHANNEL_PATTERN.search(text)
+    return m.group(1) if m else None
+
+
+def _scrape_ids(url: str) -> list[str]:
+    """Все video_id плейлиста или канала: первая порция со страницы, дальше — продолжения. Порядок сохраняем."""
+    last_err: Exception | None = None
+    for px in [*proxy_pool.candidates()[:3], None]:
+        session = session_for(px)
+        try:
+            r = session.get(url, headers={"Accept-Language": "ru,en"})
+            r.raise_for_status()
+        except Exception as e:
+            last_err = e
+            log.warning("bulk: %s через %s: %s", url, px or "direct", type(e).__name__)
+            continue
+        return _follow_continuations(session, url, r.text)
+    raise RuntimeError(f"не удалось открыть {url}: {last_err}")
+
+
+def _last_token(text: str) -> str | None:
+    tokens = CONTINUATION_TOKEN.findall(text)
+    return tokens[-1] if tokens else None
+
+
+def _follow_continuations(session, url: str, page: str) -> list[str]:
+    """Дочитать список через /youtubei/v1/browse тем же маршрутом. Не дочитали — пишем в лог, что список неполный."""
+    ids = dict.fromkeys(PAGE_VIDEO_ID.findall(page))
+    token = _last_token(page)
+    key, version = INNERTUBE_KEY.search(page), INNERTUBE_VERSION.search(page)
+    if token and (key is None or version is None):
+        log.warning("bulk: %s — список неполный (%d видео): на странице нет ключа innertube", url, len(ids))
+        return list(ids)
+    for _ in range(MAX_CONTINUATIONS):
+        if not token:
+            return list(ids)
+        try:
+            r = session.post(
+                f"https://www.youtube.com/youtubei/v1/browse?key={key.group(1)}",
+                json={"context": {"client": {"clientName": "WEB", "clientVersion": version.group(1), "hl": "ru"}}, "continuation": token},
+                headers={"Accept-Language": "ru,en"},
+            )
+            r.raise_for_status()
+        except Exception as e:
+            log.warning("bulk: %s — список неполный (%d видео): %s", url, len(ids), type(e).__name__)
+            return list(ids)
+        before = len(ids)
+        ids.update(dict.fromkeys(PAGE_VIDEO_ID.findall(r.text)))
+        token = _last_token(r.text)
+        if len(ids) == before:
+            break
+    if token:
+        log.warning("bulk: %s — список неполный (%d видео): продолжения не кончились", url, len(ids))
+    return list(ids)
+
+
+def resolve_video_ids(source: str) -> list[str]:
+    """Файл со списком id (как video_ids.txt), ссылка на плейлист или на канал."""
+    path = Path(source)
+    if path.exists():
+        return [s.strip() for s in path.read_text(encoding="utf-8").splitlines() if VIDEO_ID_RE.match(s.strip())]
+    playlist = extract_playlist_id(source)
+    if playlist:
+        return _scrape_ids(f"https://www.youtube.com/playlist?list={playlist}")
+    channel = extract_channel_path(source)
+    if channel:
+        return _scrape_ids(f"https://www.youtube.com/{channel}/videos")
+    raise SystemExit(f"Не понял источник: {source} (нужен файл с id, ссылка на плейлист или канал)")
+
+
+async def fetch_all(ids: list[str]) -> dict[str, list[tuple[float, str]]]:
+    """Транскрипты всех видео; параллельность ограничена пулом transcript.py."""
+    results = await asyncio.gather(*(fetch_transcript_timestamped_async(vid) for vid in ids))
+    out = {}
+    for vid, (snippets, err) in zip(ids, results):
+        if snippets:
+            out[vid] = maybe_compact(snippets)  # как в боте — иначе ключи кэша ответов не совпадут
+        else:
+            log.warning("bulk: %s без субтитров: %s", vid, err)
+    return out
+
+
+def build_batch(transcripts: dict[str, list[tuple[float, str]]], num_paragraphs: int) -> tuple[list[dict], list[str]]:
+    """Строки Batch API для всего, чего нет в кэше, и список длинных видео для map-reduce вне пакета."""
+    cache = get_result_cache()
+    lines, long_ids = [], []
+    for vid, snippets in transcripts.items():
+        text = " ".join(t for _, t in snippets)
+        segments = toc_segments(snippets)
+        if cache.get(toc_key(segments)) is None:
+            lines.append({"custom_id": f"{vid}:toc", "method": "POST", "url": "/v1/chat/completions", "body": toc_body(segments)})
+        if cache.get(summary_key(text, num_paragraphs)) is None:
+            if count_tokens(text) > SINGLE_PASS_TOKENS:
+                long_ids.append(vid)
+            else:
+                lines.append({"custom_id": f"{vid}:summary", "method": "POST", "url": "/v1/chat/completions", "body": summary_body(text, num_paragraphs)})
+    return lines, long_ids
+
+
+async def run_batch_local(lines: list[dict]) -> dict[str, str]:
+    """Локальная замена Batch API: те же запросы, просто параллельно через общий клиент."""
+    async def one(line: dict) -> tuple[str, str | None]:
+        try:
+            return line["custom_id"], await complete_body(line["body"])
+        except Exception as e:
+            log.warning("bulk: %s: %s", line["custom_id"], type(e).__name__)
+            return line["custom_id"], None
+
+    return {cid: content for cid, content in await asyncio.gather(*(one(x) for x in lines)) if content}
+
+
+async def run_batch_openai(path: Path) -> dict[str, str]:
+    """Настоящий OpenAI Batch API: загрузить JSONL, дождаться завершения, забрать ответы."""
+    client = get_openai()
+    with path.open("rb") as f:
+        uploaded = await client.files.create(file=f, purpose="batch")
+    batch = await client.batches.create(input_file_id=uploaded.id, endpoint="/v1/chat/completions", completion_window="24h")
+    print(f"Batch {batch.id} отправлен, ждём…", flush=True)
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_SEC)
+        batch = await client.batches.retrieve(batch.id)
+        print(f"  {batch.status}: {batch.request_counts}", flush=True)
+    if not batch.output_file_id:
+        raise RuntimeError(f"batch {batch.id}: {batch.status}")
+    raw = (await client.files.content(batch.output_file_id)).text
+    out = {}
+    for line in raw.splitlines():
+        item = json.loads(line)
+        try:
+            out[item["custom_id"]] = item["response"]["body"]["choices"][0]["message"]["content"].strip()
+        except (KeyError, IndexError, TypeError):
+            log.warning("bulk: %s без ответа", item.get("custom_id"))
+    return out
+
+
+async def process(source: str, num_paragraphs: int, use_openai_batch: bool) -> int:
+    started = time.monotonic()
+    ids = resolve_video_ids(source)
+    print(f"Видео: {len(ids)}", flush=True)
+    transcripts = await fetch_all(ids)
+    print(f"С субтитрами: {len(transcripts)} ({time.monotonic() - started:.0f} с)", flush=True)
+    if get_openai() is None:
+        print("Не задан OPENAI_API_KEY", file=sys.stderr)
+        return 1
+
+    lines, long_ids = build_batch(transcripts, num_paragraphs)
+    BATCH_FILE.write_text("".join(json.dumps(x, ensure_ascii=False) + "\n" for x in lines), encoding="utf-8")
+    print(f"Запросов в пакете: {len(lines)}, длинных видео (map-reduce): {len(long_ids)}", flush=True)
+    answers = {}
+    if lines:
+        answers = await run_batch_openai(BATCH_FILE) if use_openai_batch else await run_batch_local(lines)
+
+    # Ответы — в кэш под ключами бота, длинные видео — обычным путём (он сам кладёт в кэш)
+    cache = get_result_cache()
+    for vid, snippets in transcripts.items():
+        segments = toc_segments(snippets)
+        if f"{vid}:toc" in answers:
+            cache.put(toc_key(segments), parse_toc_lines(answers[f"{vid}:toc"], len(segments)))
+        if f"{vid}:summary" in answers:
+            cache.put(summary_key(" ".join(t for _, t in snippets), num_paragraphs), answers[f"{vid}:summary"])
+    await asyncio.gather(*(summarize_snippets(transcripts[vid], num_paragraphs) for vid in long_ids))
+
+    written = 0
+    with gzip.open(OUTPUT_FILE, "at", encoding="utf-8") as out:
+        for vid, snippets in transcripts.items():
+            segments = toc_segments(snippets)
+            toc = cache.get(toc_key(segments))
+            summary = cache.get(summary_key(" ".join(t for _, t in snippets), num_paragraphs))
+            if toc is None or summary is None:
+                continue
+            out.write(json.dumps({
+                "video_id": vid,
+                "paragraphs": num_paragraphs,
+                "toc": [[int(start), line] for (start, _), line in zip(segments, toc)],
+                "summary": summary,
+            }, ensure_ascii=False) + "\n")
+            written += 1
+    print(f"--- Готово: {written}/{len(ids)} видео за {(time.monotonic() - started) / 60:.1f} мин → {OUTPUT_FILE.name}", flush=True)
+    return 0
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("source", help="video_ids.txt, ссылка на плейлист (…list=…) или на канал (youtube.com/@…)")
+    parser.add_argument("--paragraphs", type=int, default=DEFAULT_PARAGRAPHS, help="абзацев в выжимке")
+    parser.add_argument("--openai-batch", action="store_true", help="отправить через OpenAI Batch API вместо локального выполнения")
+    args = parser.parse_args()
+    return asyncio.run(process(args.source, args.paragraphs, args.openai_batch))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
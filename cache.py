@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Дисковые кэши (SQLite): транскрипты по video_id (TTL + LRU по размеру) и результаты LLM по хэшу входа."""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from metrics import cache_requests
+
+CACHE_DB = Path(os.environ.get("CACHE_DB", Path(__file__).parent / "cache.sqlite3"))
+# Сколько хранить транскрипт и сколько места (сжатых данных) максимум
+TRANSCRIPT_CACHE_TTL = float(os.environ.get("TRANSCRIPT_CACHE_TTL_HOURS", "168")) * 3600
+TRANSCRIPT_CACHE_MAX_BYTES = int(float(os.environ.get("TRANSCRIPT_CACHE_MAX_MB", "100")) * 1024 * 1024)
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL_HOURS", "720")) * 3600
+RESULT_CACHE_MAX_BYTES = int(float(os.environ.get("RESULT_CACHE_MAX_MB", "50")) * 1024 * 1024)
+# Сколько помнить, что у видео нет субтитров: недолго — автосубтитры могут появиться через несколько минут после заливки
+NO_CAPTIONS_TTL = float(os.environ.get("NO_CAPTIONS_TTL_MINUTES", "30")) * 60
+
+log = logging.getLogger(__name__)
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    """Соединение SQLite в режиме WAL, общее для потоков (доступ сериализуют блокировки хранилищ)."""
+    conn = sqlite3.connect(str(path), timeout=30, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class TranscriptCache:
+    """Транскрипты в SQLite, сжатые zlib. Старше ttl — промах; больше max_bytes — вытесняем давно не читанные.
+    Отдельно — отрицательные ответы («субтитров нет») на missing_ttl, чтобы не ходить за ними по всем прокси."""
+
+    def __init__(self, path: Path = CACHE_DB, ttl: float = TRANSCRIPT_CACHE_TTL, max_bytes: int = TRANSCRIPT_CACHE_MAX_BYTES,
+                 missing_ttl: float = NO_CAPTIONS_TTL):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.missing_ttl = missing_ttl
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS transcripts (
+                video_id TEXT PRIMARY KEY,
+                language TEXT,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS transcripts_accessed ON transcripts(accessed_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transcript_misses (video_id TEXT PRIMARY KEY, reason TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+
+    def get(self, video_id: str, touch: bool = True) -> tuple[list[tuple[float, str]], str | None] | None:
+        """(сниппеты, язык) или None, если нет или протух. touch=False — служебное чтение: не влияет на LRU и метрики."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT language, data, created_at FROM transcripts WHERE video_id = ?", (video_id,)
+            ).fetchone()
+            if row is None or now - row[2] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM transcripts WHERE video_id = ?", (video_id,))
+                if touch:
+                    cache_requests.inc(cache="transcript", result="miss")
+                return None
+            language, data, _ = row
+            if touch:
+                self._conn.execute("UPDATE transcripts SET accessed_at = ? WHERE video_id = ?", (now, video_id))
+        try:
+            snippets = [(float(s), t) for s, t in json.loads(zlib.decompress(data))]
+        except (zlib.error, ValueError, TypeError) as e:
+            log.warning("transcript cache %s: битая запись (%s)", video_id, type(e).__name__)
+            if touch:
+                cache_requests.inc(cache="transcript", result="miss")
+            return None
+        if touch:
+            cache_requests.inc(cache="transcript", result="hit")
+        return snippets, language
+
+    def video_ids(self) -> list[str]:
+        """Все непротухшие video_id (для индекса корпуса)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT video_id FROM transcripts WHERE created_at >= ?", (time.time() - self.ttl,)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def put(self, video_id: str, snippets: list[tuple[float, str]], language: str | None = None) -> None:
+        data = zlib.compress(json.dumps(snippets, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO transcripts (video_id, language, data, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (video_id, language, data, len(data), now, now),
+            )
+            self._conn.execute("DELETE FROM transcript_misses WHERE video_id = ?", (video_id,))
+            self._evict(now)
+
+    def get_missing(self, video_id: str) -> str | None:
+        """Причина, по которой субтитров недавно не оказалось, или None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT reason, created_at FROM transcript_misses WHERE video_id = ?", (video_id,)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.missing_ttl:
+            cache_requests.inc(cache="no_captions", result="miss")
+            return None
+        cache_requests.inc(cache="no_captions", result="hit")
+        return row[0]
+
+    def put_missing(self, video_id: str, reason: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO transcript_misses (video_id, reason, created_at) VALUES (?, ?, ?)",
+                (video_id, reason, now),
+            )
+            self._conn.execute("DELETE FROM transcript_misses WHERE created_at < ?", (now - self.missing_ttl,))
+
+    def _evict(self, now: float) -> None:
+        """Удалить протухшие, затем самые давно читанные, пока не влезем в max_bytes. Вызывать под локом."""
+        self._conn.execute("DELETE FROM transcripts WHERE created_at < ?", (now - self.ttl,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM transcripts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT video_id, size FROM transcripts ORDER BY accessed_at").fetchall()
+        drop = []
+        for video_id, size in rows:
+            if total <= self.max_bytes:
+                break
+            drop.append((video_id,))
+            total -= size
+        self._conn.executemany("DELETE FROM transcripts WHERE video_id = ?", drop)
+        log.info("transcript cache: вытеснено %d записей", len(drop))
+
+
+def result_key(kind: str, model: str, prompt_version: str, num_paragraphs: int, content: str) -> str:
+    """Ключ по содержимому: sha256(вид, модель, версия промпта, абзацы, текст транскрипта)."""
+    h = hashlib.sha256()
+    for part in (kind, model, prompt_version, str(num_paragraphs)):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(content.encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Готовые ответы LLM (выжимка, оглавление, конспекты кусков, /ask) по ключу из result_key.
+    Протухшие удаляем при записи; больше max_bytes — вытесняем самые старые."""
+
+    def __init__(self, path: Path = CACHE_DB, ttl: float = RESULT_CACHE_TTL, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS llm_results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        # Таблица из версии без учёта размера: добавить колонку (старые записи считаются нулевыми, пока не протухнут)
+        if "size" not in {r[1] for r in self._conn.execute("PRAGMA table_info(llm_results)")}:
+            self._conn.execute("ALTER TABLE llm_results ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_results_created ON llm_results(created_at)")
+
+    def get(self, key: str):
+        """Сохранённое значение (str или list) или None."""
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM llm_results WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                cache_requests.inc(cache="result", result="miss")
+                return None
+            cache_requests.inc(cache="result", result="hit")
+        return json.loads(row[0])
+
+    def put(self, key: str, value) -> None:
+        data = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_results (key, value, created_at, size) VALUES (?, ?, ?, ?)",
+                (key, data, now, len(data.encode("utf-8"))),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """Удалить протухшие, затем самые старые, пока не влезем в max_bytes. Вызывать под локом."""
+        self._conn.execute("DELETE FROM llm_results WHERE created_at < ?", (now - self.ttl,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        drop = []
+        for key, size in self._conn.execute("SELECT key, size FROM llm_results ORDER BY created_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            drop.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM llm_results WHERE key = ?", drop)
+        log.info("result cache: вытеснено %d записей", len(drop))
+
+
+_transcript_cache: TranscriptCache | None = None
+_result_cache: ResultCache | None = None
+_init_lock = threading.Lock()
+
+
+def get_transcript_cache() -> TranscriptCache:
+    """Общий на процесс экземпляр кэша транскриптов."""
+    global _transcript_cache
+    with _init_lock:
+        if _transcript_cache is None:
+            _transcript_cache = TranscriptCache()
+        return _transcript_cache
+
+
+def get_result_cache() -> ResultCache:
+    """Общий на процесс кэш ответов LLM."""
+    global _result_cache
+    with _init_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
-"""Проверить список прокси на YouTube transcript API. Первый рабочий — в proxy_working.txt.
-Нерабочие пишем в proxy_failed.txt и больше не проверяем. Подтягивает свежий список из сети."""
+"""Проверить список прокси на YouTube transcript API — параллельно, все сразу.
+Рабочие, отсортированные по задержке, — в proxies_working_list.txt (его читает transcript.py), лучший — в proxy_working.txt.
+Нерабочие пишем в proxy_failed.txt с временем провала и перепроверяем через RETRY_FAILED_HOURS.
+Подтягивает свежий список из сети. С --every N повторяет проверку раз в N минут."""
+import argparse
 import re
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from requests import Session
 from youtube_transcript_api import YouTubeTranscriptApi
@@ -10,6 +15,8 @@ from youtube_transcript_api import YouTubeTranscriptApi
 BASE = Path(__file__).parent
 PROXY_FAILED_FILE = BASE / "proxy_failed.txt"
 PROXY_FRESH_FILE = BASE / "proxies_fresh.txt"  # до 100 свежих с веба
+PROXY_WORKING_FILE = BASE / "proxy_working.txt"
+PROXY_LIST_FILE = BASE / "proxies_working_list.txt"
 PROXY_SOURCES = [
     "https://raw.githubusercontent.com/proxifly/free-proxy-list/main/proxies/protocols/http/data.txt",
     "http://pubproxy.com/api/proxy?limit=30&format=txt&type=http",
@@ -82,11 +89,52 @@ http://34.80.202.6:3128
 
 VID = "ok_TCBX9clw"
 TIMEOUT = 12
+WORKERS = 32  # сколько прокси проверять одновременно
+RETRY_FAILED_HOURS = 24  # через сколько часов снова проверять упавший прокси
 
-def main():
-    failed = set()
+
+def load_failed() -> dict[str, float]:
+    """proxy_failed.txt: «прокси<TAB>unix-время провала». Старый формат без времени — считаем, что упал сейчас."""
+    failed = {}
     if PROXY_FAILED_FILE.exists():
-        failed = {s.strip() for s in PROXY_FAILED_FILE.read_text(encoding="utf-8").splitlines() if s.strip()}
+        now = time.time()
+        for line in PROXY_FAILED_FILE.read_text(encoding="utf-8").splitlines():
+            px, _, ts = line.strip().partition("\t")
+            if px:
+                try:
+                    failed[px] = float(ts) if ts else now
+                except ValueError:
+                    failed[px] = now
+    return failed
+
+
+def save_failed(failed: dict[str, float]) -> None:
+    PROXY_FAILED_FILE.write_text("\n".join(f"{px}\t{ts:.0f}" for px, ts in sorted(failed.items())), encoding="utf-8")
+
+
+def _with_timeout(request, timeout: float):
+    def wrapped(*args, **kwargs):
+        kwargs.setdefault("timeout", timeout)
+        return request(*args, **kwargs)
+    return wrapped
+
+
+def check_proxy(px: str, timeout: float = TIMEOUT) -> tuple[str, float | None, str | None]:
+    """(прокси, задержка в сек или None, ошибка или None)."""
+    started = time.monotonic()
+    try:
+        s = Session()
+        s.proxies = {"http": px, "https": px}
+        s.request = _with_timeout(s.request, timeout)
+        api = YouTubeTranscriptApi(http_client=s)
+        api.fetch(VID, languages=("ru", "en"))
+        return px, time.monotonic() - started, None
+    except Exception as e:
+        return px, None, type(e).__name__
+
+
+def candidates(failed: dict[str, float], retry_after: float) -> list[str]:
+    """Свежие с веба (из файла или скачать) + статический список, без недавно упавших. Порядок сохраняем."""
     # Свежие 100: из файла или подтянуть с веба и сохранить
     if PROXY_FRESH_FILE.exists():
         from_fresh = [s.strip() for s in PROXY_FRESH_FILE.read_text(encoding="utf-8").splitlines() if s.strip()]
@@ -96,26 +144,65 @@ def main():
         from_web = fetch_proxies_from_web(limit=100)
         PROXY_FRESH_FILE.write_text("\n".join(from_web[:100]), encoding="utf-8")
         from_fresh = from_web[:100]
-    from_fresh = [p for p in from_fresh if p not in failed]
-    from_static = [p.strip() for p in PROXIES_TO_TRY_RAW if p.strip() and p.strip() not in failed]
-    to_try = from_fresh[:100] + from_static
-    out_file = BASE / "proxy_working.txt"
-    for i, px in enumerate(to_try):
-        try:
-            s = Session()
-            s.proxies = {"http": px, "https": px}
-            s.timeout = TIMEOUT
-            api = YouTubeTranscriptApi(http_client=s)
-            t = api.fetch(VID, languages=("ru", "en"))
-            out_file.write_text(px, encoding="utf-8")
-            print(f"OK {px} ({len(t.snippets)} snippets)")
-            return 0
-        except Exception as e:
-            failed.add(px)
-            PROXY_FAILED_FILE.write_text("\n".join(sorted(failed)), encoding="utf-8")
-            print(f"{i+1}/{len(to_try)} {px} {type(e).__name__}", file=sys.stderr)
-    print("Ни один прокси не сработал", file=sys.stderr)
-    return 1
+    # Уже работающие тоже перепроверяем — чтобы из списка уходили умершие
+    working = []
+    if PROXY_LIST_FILE.exists():
+        working = [s.strip() for s in PROXY_LIST_FILE.read_text(encoding="utf-8").splitlines() if s.strip()]
+    now = time.time()
+    out, seen = [], set()
+    for px in working + from_fresh[:100] + [p.strip() for p in PROXIES_TO_TRY_RAW if p.strip()]:
+        if px in seen or now - failed.get(px, 0.0) < retry_after:
+            continue
+        seen.add(px)
+        out.append(px)
+    return out
+
+
+def run_once(workers: int = WORKERS, timeout: float = TIMEOUT, retry_after: float = RETRY_FAILED_HOURS * 3600) -> int:
+    failed = load_failed()
+    to_try = candidates(failed, retry_after)
+    if not to_try:
+        print("Нечего проверять: все прокси недавно падали", file=sys.stderr)
+        return 1
+    started = time.monotonic()
+    ok: list[tuple[float, str]] = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(check_proxy, px, timeout) for px in to_try]
+        for i, f in enumerate(as_completed(futures), 1):
+            px, latency, err = f.result()
+            if latency is not None:
+                ok.append((latency, px))
+                failed.pop(px, None)
+                print(f"{i}/{len(to_try)} OK {px} {latency:.1f}s")
+            else:
+                failed[px] = time.time()
+                print(f"{i}/{len(to_try)} {px} {err}", file=sys.stderr)
+    save_failed(failed)
+    ok.sort()
+    elapsed = time.monotonic() - started
+    if not ok:
+        print(f"Ни один прокси не сработал ({len(to_try)} за {elapsed:.0f} с)", file=sys.stderr)
+        return 1
+    PROXY_LIST_FILE.write_text("\n".join(px for _, px in ok), encoding="utf-8")
+    PROXY_WORKING_FILE.write_text(ok[0][1], encoding="utf-8")
+    print(f"Рабочих: {len(ok)} из {len(to_try)} за {elapsed:.0f} с. Лучший: {ok[0][1]} ({ok[0][0]:.1f}s)")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="сколько прокси проверять одновременно")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="таймаут одного запроса, сек")
+    parser.add_argument("--retry-failed-hours", type=float, default=RETRY_FAILED_HOURS, help="через сколько часов перепроверять упавшие")
+    parser.add_argument("--every", type=float, default=0, help="повторять раз в N минут (0 — один раз)")
+    args = parser.parse_args()
+    while True:
+        code = run_once(args.workers, args.timeout, args.retry_failed_hours * 3600)
+        if args.every <= 0:
+            return code
+        # Свежий список с веба — на каждый проход
+        PROXY_FRESH_FILE.unlink(missing_ok=True)
+        time.sleep(args.every * 60)
 
 if __name__ == "__main__":
     sys.exit(main())
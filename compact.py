@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Сжатие транскрипта перед LLM: автосубтитры YouTube полны повторов и мусора, а он стоит токенов.
+- теги не-речи: [Музыка], [Аплодисменты], (смех), ♪, >>;
+- «бегущие» субтитры: начало сниппета повторяет конец предыдущего — перекрытие убираем;
+- повторы подряд: «да да да», «вот это вот это» → один раз; междометия «эээ», «um».
+Таймкоды не трогаем: у каждого оставшегося сниппета его собственный start, пустые сниппеты выкидываем."""
+import os
+import re
+
+# 1 — сжимать транскрипт перед запросами к LLM, 0 — отдавать как есть
+TRANSCRIPT_COMPACTION = os.environ.get("TRANSCRIPT_COMPACTION", "1") == "1"
+# Сколько последних слов предыдущего сниппета сравнивать с началом следующего; короче MIN_OVERLAP — не перекрытие
+# (одно-два совпавших слова на стыке — обычно просто речь, а короткие повторы ловит схлопывание)
+OVERLAP_WINDOW = 20
+MIN_OVERLAP = 3
+# Самая длинная фраза (в словах), повтор которой подряд схлопываем
+MAX_REPEAT_NGRAM = 4
+
+_TAGS = re.compile(r"\[[^\]]{0,40}\]|\((?:музыка|смех|аплодисменты|music|laughter|applause|inaudible)[^)]{0,20}\)|[♪♫]+|>>", re.IGNORECASE)
+_FILLERS = frozenset({"э", "ээ", "эээ", "эм", "эмм", "ммм", "мм", "uh", "um", "uhm", "erm", "hmm"})
+
+
+def _norm(word: str) -> str:
+    return word.strip(".,!?;:…\"«»'()-—").lower()
+
+
+def _overlap(history: list[str], norm: list[str]) -> int:
+    """Длина самого длинного начала norm (не короче MIN_OVERLAP), которым заканчивается history."""
+    for k in range(min(len(history), len(norm)), MIN_OVERLAP - 1, -1):
+        if history[-k:] == norm[:k]:
+            return k
+    return 0
+
+
+def _collapse_repeats(words: list[str], norm: list[str], history: list[str]) -> list[str]:
+    """Выкинуть фразы до MAX_REPEAT_NGRAM слов, повторяющие только что сказанное.
+    history — нормализованные последние оставленные слова (в т.ч. из прошлых сниппетов); дополняется."""
+    out: list[str] = []
+    i = 0
+    while i < len(words):
+        # Повтор фразы длины n начинается со слова, сказанного n слов назад — без него и проверять нечего
+        if norm[i] in history[-MAX_REPEAT_NGRAM:]:
+            for n in range(MAX_REPEAT_NGRAM, 0, -1):
+                if len(history) >= n and history[-n:] == norm[i:i + n]:
+                    i += n
+                    break
+            else:
+                n = 0
+            if n:
+                continue
+        out.append(words[i])
+        history.append(norm[i])
+        i += 1
+    return out
+
+
+def compact_snippets(snippets: list[tuple[float, str]]) -> list[tuple[float, str]]:
+    """Сжатые сниппеты с исходными таймкодами. Перекрытия и повторы ищем и через границу сниппетов."""
+    out: list[tuple[float, str]] = []
+    history: list[str] = []
+    for start, text in snippets:
+        words, norm = [], []
+        for w in _TAGS.sub(" ", text).split():
+            n = _norm(w)
+            if n not in _FILLERS:
+                words.append(w)
+                norm.append(n)
+        k = _overlap(history, norm)
+        keep = _collapse_repeats(words[k:], norm[k:], history)
+        del history[:-OVERLAP_WINDOW]
+        if keep:
+            out.append((start, " ".join(keep)))
+    return out
+
+
+def maybe_compact(snippets: list[tuple[float, str]]) -> list[tuple[float, str]]:
+    """compact_snippets, если включено TRANSCRIPT_COMPACTION; пустой результат — исходные сниппеты."""
+    if not TRANSCRIPT_COMPACTION or not snippets:
+        return snippets
+    return compact_snippets(snippets) or snippets
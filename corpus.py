@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""Корпус транскриптов для /ask: полнотекстовый индекс (SQLite FTS5, ранжирование BM25) по кускам с таймкодами.
+Источники: кэш транскриптов (с таймкодами) и папка transcripts/ от download_transcripts.py (только текст).
+Индекс инкрементальный: видео попадает в него после загрузки транскрипта (в фоновом потоке, ответ не ждёт),
+а sync() досматривает то, что появилось в обход этого процесса (новые .txt, кэш, заполненный воркерами).
+Больше CORPUS_MAX_MB — выкидываем куски давно проиндексированных видео (запись о видео остаётся, sync их не вернёт). Поиск — по инвертированному
+индексу FTS5 без слишком частых слов, поэтому время запроса почти не зависит от числа видео.
+  python corpus.py                       — досинхронизировать индекс
+  python corpus.py --search "вопрос"     — показать найденные куски"""
+import argparse
+import contextvars
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from cache import connect, get_transcript_cache
+from compact import maybe_compact
+from metrics import corpus_search_seconds
+from toc import sec_to_mmss
+
+CORPUS_DB = Path(os.environ.get("CORPUS_DB", Path(__file__).parent / "corpus.sqlite3"))
+TRANSCRIPTS_DIR = Path(__file__).parent / "transcripts"
+# 1 — добавлять в индекс каждый загруженный транскрипт, 0 — только через sync()
+CORPUS_INDEX = os.environ.get("CORPUS_INDEX", "1") == "1"
+# Сколько места может занять индекс (текст кусков + FTS5), МБ
+CORPUS_MAX_BYTES = int(float(os.environ.get("CORPUS_MAX_MB", "200")) * 1024 * 1024)
+# Кусок — примерно CHUNK_SECONDS речи (с таймкодами) или CHUNK_WORDS слов (из .txt без таймкодов)
+CHUNK_SECONDS = 60
+CHUNK_WORDS = 150
+# Сколько кусков отдавать в ответ на вопрос и сколько максимум из одного видео
+ASK_TOP_K = int(os.environ.get("ASK_TOP_K", "6"))
+MAX_CHUNKS_PER_VIDEO = 2
+# Больше стольких слов вопроса в запрос к индексу не берём
+MAX_QUERY_TERMS = 12
+# Слово, которое есть больше чем в такой доле кусков, почти не влияет на BM25, а поиск с ним читает весь индекс —
+# выкидываем (если в индексе хотя бы COMMON_TERM_MIN_CHUNKS кусков; если все слова такие — оставляем самое редкое)
+COMMON_TERM_SHARE = 0.05
+COMMON_TERM_MIN_CHUNKS = 2000
+
+_WORD = re.compile(r"\w+")
+_STOPWORDS = frozenset(
+    "и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот от меня "
+    "еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас нибудь опять уж вам ведь там потом "
+    "себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе под "
+    "будет ж тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда "
+    "зачем всех никогда можно при наконец два об другой хоть после над больше тот через эти нас про всего них какая много "
+    "разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между "
+    "это видео говорит говорил "
+    "the a an and or of to in on for is are was were be been it this that with as at by from what how why who which "
+    "do does did not no can about video".split()
+)
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Hit:
+    video_id: str
+    start: float | None  # None — кусок из .txt без таймкодов
+    text: str
+
+    @property
+    def url(self) -> str:
+        if self.start is None:
+            return f"https://www.youtube.com/watch?v={self.video_id}"
+        return f"https://www.youtube.com/watch?v={self.video_id}&t={int(self.start)}"
+
+    @property
+    def label(self) -> str:
+        if self.start is None:
+            return self.video_id
+        return f"{self.video_id} {sec_to_mmss(self.start)}"
+
+
+def chunk_snippets(snippets: list[tuple[float, str]]) -> list[tuple[float, str]]:
+    """Склеить сниппеты в куски по ~CHUNK_SECONDS; у куска — таймкод его первого сниппета."""
+    out: list[tuple[float, str]] = []
+    start, parts = None, []
+    for s, text in snippets:
+        if start is not None and s - start >= CHUNK_SECONDS:
+            out.append((start, " ".join(parts)))
+            start, parts = None, []
+        if start is None:
+            start = s
+        parts.append(text)
+    if parts:
+        out.append((start, " ".join(parts)))
+    return out
+
+
+def chunk_text(text: str) -> list[tuple[None, str]]:
+    words = text.split()
+    return [(None, " ".join(words[i:i + CHUNK_WORDS])) for i in range(0, len(words), CHUNK_WORDS)]
+
+
+def _fold(word: str) -> str:
+    """Как токенизатор индекса (unicode61, remove_diacritics): без диакритики, «й» → «и», «ё» → «е»."""
+    return "".join(ch for ch in unicodedata.normalize("NFD", word) if unicodedata.category(ch) != "Mn")
+
+
+def query_terms(question: str) -> list[tuple[str, bool]]:
+    """Значимые слова вопроса: (терм, префикс ли). От слов длиннее трёх букв — префикс (грубо срезаем окончания)."""
+    terms: list[tuple[str, bool]] = []
+    for w in _WORD.findall(question.lower()):
+        if w in _STOPWORDS or len(w) < 2:
+            continue
+        w = _fold(w)
+        term = (w, False) if len(w) < 4 else (w[:max(4, len(w) - 3)], True)
+        if term not in terms:
+            terms.append(term)
+    return terms[:MAX_QUERY_TERMS]
+
+
+def build_query(terms: list[tuple[str, bool]]) -> str:
+    """Запрос FTS5: термы через OR."""
+    return " OR ".join(f'"{w}"*' if prefix else f'"{w}"' for w, prefix in terms)
+
+
+class Corpus:
+    """Индекс: videos — что и откуда проиндексировано, chunks — тексты кусков, chunks_fts — FTS5 поверх chunks."""
+
+    def __init__(self, path: Path = CORPUS_DB, max_bytes: int = CORPUS_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS videos (
+                video_id TEXT PRIMARY KEY,
+                timestamped INTEGER NOT NULL,
+                source_mtime REAL,
+                indexed_at REAL NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS videos_indexed ON videos(indexed_at);
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                video_id TEXT NOT NULL,
+                start REAL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chunks_video ON chunks(video_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+                text, content='chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_vocab USING fts5vocab(chunks_fts, 'row');"""
+        )
+
+    def indexed(self) -> dict[str, tuple[bool, float | None]]:
+        """video_id → (с таймкодами ли, mtime исходного .txt)."""
+        with self._lock:
+            rows = self._conn.execute("SELECT video_id, timestamped, source_mtime FROM videos").fetchall()
+        return {vid: (bool(ts), mtime) for vid, ts, mtime in rows}
+
+    def add(self, video_id: str, chunks: list[tuple[float | None, str]], timestamped: bool,
+            source_mtime: float | None = None) -> None:
+        """Заменить куски видео одной транзакцией; если индекс разросся — вытеснить старые видео."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete_chunks(video_id)
+                for start, text in chunks:
+                    cur = self._conn.execute(
+                        "INSERT INTO chunks (video_id, start, text) VALUES (?, ?, ?)", (video_id, start, text)
+                    )
+                    self._conn.execute("INSERT INTO chunks_fts (rowid, text) VALUES (?, ?)", (cur.lastrowid, text))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO videos (video_id, timestamped, source_mtime, indexed_at, size) VALUES (?, ?, ?, ?, ?)",
+                    (video_id, int(timestamped), source_mtime, time.time(), sum(len(text.encode("utf-8")) for _, text in chunks)),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._evict()
+
+    def _delete_chunks(self, video_id: str) -> None:
+        """Убрать куски видео из chunks и FTS5 (у external content — вручную). Вызывать под локом в транзакции."""
+        old = self._conn.execute("SELECT id, text FROM chunks WHERE video_id = ?", (video_id,)).fetchall()
+        self._conn.executemany("INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', ?, ?)", old)
+        self._conn.execute("DELETE FROM chunks WHERE video_id = ?", (video_id,))
+
+    def _used_bytes(self) -> int:
+        page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        free = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free) * self._conn.execute("PRAGMA page_size").fetchone()[0]
+
+    def _evict(self) -> None:
+        """Больше max_bytes — выкинуть куски самых давно проиндексированных видео до ~90% лимита. Вызывать под локом.
+        Освободившиеся страницы SQLite переиспользует, так что файл дальше не растёт."""
+        used = self._used_bytes()
+        if used <= self.max_bytes:
+            return
+        text_total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM videos").fetchone()[0]
+        if not text_total:
+            return
+        # Байт базы на байт текста — used / text_total (таблица кусков + FTS5): столько текста и выкидываем
+        need = (used - self.max_bytes * 0.9) * text_total / used
+        drop = []
+        for vid, size in self._conn.execute("SELECT video_id, size FROM videos WHERE size > 0 ORDER BY indexed_at").fetchall():
+            if need <= 0:
+                break
+            drop.append(vid)
+            need -= size
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            for vid in drop:
+                self._delete_chunks(vid)
+            self._conn.executemany("UPDATE videos SET size = 0 WHERE video_id = ?", [(vid,) for vid in drop])
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        log.info("corpus: вытеснено %d видео", len(drop))
+
+    def add_snippets(self, video_id: str, snippets: list[tuple[float, str]]) -> None:
+        self.add(video_id, chunk_snippets(maybe_compact(snippets)), timestamped=True)
+
+    def _selective(self, terms: list[tuple[str, bool]]) -> tuple[list[tuple[str, bool]], bool]:
+        """Убрать слишком частые термы (см. COMMON_TERM_SHARE); вернуть (термы, ранжировать ли). Вызывать под локом."""
+        total = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM chunks").fetchone()[0]  # ≈ число кусков
+        if total < COMMON_TERM_MIN_CHUNKS:
+            return terms, True
+        docs = []
+        for w, prefix in terms:
+            if prefix:
+                # Все термы с этим префиксом: [w, w с последним символом +1)
+                row = self._conn.execute(
+                    "SELECT COALESCE(SUM(doc), 0) FROM chunks_vocab WHERE term >= ? AND term < ?",
+                    (w, w[:-1] + chr(ord(w[-1]) + 1)),
+                ).fetchone()
+            else:
+                row = self._conn.execute("SELECT COALESCE(SUM(doc), 0) FROM chunks_vocab WHERE term = ?", (w,)).fetchone()
+            docs.append(row[0])
+        kept = [t for t, n in zip(terms, docs) if n <= total * COMMON_TERM_SHARE]
+        if kept:
+            return kept, True
+        # Все слова есть почти везде: BM25 ничего не различит, а посчитает его для каждого куска — берём свежие
+        return [min(zip(docs, terms))[1]], False
+
+    def search(self, question: str, k: int = ASK_TOP_K) -> list[Hit]:
+        """Лучшие по BM25 куски, не больше MAX_CHUNKS_PER_VIDEO из одного видео."""
+        terms = query_terms(question)
+        if not terms:
+            return []
+        with corpus_search_seconds.time():
+            with self._lock:
+                terms, ranked = self._selective(terms)
+                # Без ранжирования куски идут подряд по видео — читаем с запасом, чтобы набрать разные видео
+                limit = k * MAX_CHUNKS_PER_VIDEO * (2 if ranked else 20)
+                rows = self._conn.execute(
+                    "SELECT c.video_id, c.start, c.text FROM chunks_fts JOIN chunks c ON c.id = chunks_fts.rowid "
+                    "WHERE chunks_fts MATCH ? ORDER BY " + ("rank" if ranked else "chunks_fts.rowid DESC") + " LIMIT ?",
+                    (build_query(terms), limit),
+                ).fetchall()
+        hits: list[Hit] = []
+        per_video: dict[str, int] = {}
+        for vid, start, text in rows:
+            if per_video.get(vid, 0) >= MAX_CHUNKS_PER_VIDEO:
+                continue
+            per_video[vid] = per_video.get(vid, 0) + 1
+            hits.append(Hit(vid, start, text))
+            if len(hits) >= k:
+                break
+        return hits
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            videos = self._conn.execute("SELECT COUNT(*) FROM videos WHERE size > 0").fetchone()[0]
+            chunks = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        return {"videos": videos, "chunks": chunks}
+
+    def sync(self, directory: Path = TRANSCRIPTS_DIR) -> int:
+        """Добавить то, чего ещё нет в индексе: транскрипты из кэша и новые или изменённые .txt.
+        Для .txt сначала смотрим кэш — там тот же текст, но с таймкодами. Вернуть число добавленных видео."""
+        known = self.indexed()
+        cache = get_transcript_cache()
+        added = 0
+        for vid in cache.video_ids():
+            if vid in known and known[vid][0]:
+                continue
+            cached = cache.get(vid, touch=False)
+            if cached is not None:
+                self.add_snippets(vid, cached[0])
+                known[vid] = (True, None)
+                added += 1
+        if directory.is_dir():
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".txt"):
+                        continue
+                    vid = entry.name[:-4]
+                    mtime = entry.stat().st_mtime
+                    state = known.get(vid)
+                    if state is not None and (state[0] or (state[1] or 0) >= mtime):
+                        continue
+                    text = Path(entry.path).read_text(encoding="utf-8")
+                    self.add(vid, chunk_text(text), timestamped=False, source_mtime=mtime)
+                    added += 1
+        if added:
+            log.info("corpus: добавлено %d видео, всего %s", added, self.stats())
+        return added
+
+
+_corpus: Corpus | None = None
+_init_lock = threading.Lock()
+
+
+def get_corpus() -> Corpus:
+    """Общий на процесс индекс."""
+    global _corpus
+    with _init_lock:
+        if _corpus is None:
+            _corpus = Corpus()
+        return _corpus
+
+
+# Индексация — в одном фоновом потоке: записи в индекс идут по очереди и не задерживают ответ пользователю
+_index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="corpus-index")
+
+
+def _index(video_id: str, snippets: list[tuple[float, str]]) -> None:
+    try:
+        get_corpus().add_snippets(video_id, snippets)
+    except sqlite3.Error as e:
+        log.warning("corpus %s: не удалось проиндексировать: %s", video_id, e)
+
+
+def index_transcript(video_id: str, snippets: list[tuple[float, str]]) -> None:
+    """Поставить свежий транскрипт в очередь на индексацию (если включено CORPUS_INDEX) и сразу вернуться.
+    Ошибка индекса загрузку не ломает."""
+    if CORPUS_INDEX:
+        _index_executor.submit(contextvars.copy_context().run, _index, video_id, snippets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", type=Path, default=TRANSCRIPTS_DIR, help="папка с .txt (по умолчанию transcripts/)")
+    parser.add_argument("--search", help="вместо синхронизации — найти куски по вопросу")
+    parser.add_argument("-k", type=int, default=ASK_TOP_K, help="сколько кусков показать")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    corpus = get_corpus()
+    if args.search:
+        started = time.perf_counter()
+        hits = corpus.search(args.search, args.k)
+        print(f"{len(hits)} кусков за {(time.perf_counter() - started) * 1000:.1f} мс")
+        for h in hits:
+            print(f"\n{h.url}\n{h.text[:300]}")
+        return
+    started = time.monotonic()
+    added = corpus.sync(args.dir)
+    print(f"Добавлено видео: {added} за {time.monotonic() - started:.1f} с; в индексе: {corpus.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,75 +1,210 @@
 #!/usr/bin/env python3
-"""Скачать транскрипты всех видео из video_ids.txt в папку transcripts/."""
+"""Скачать транскрипты всех видео из video_ids.txt в папку transcripts/ — параллельно по всем прокси.
+На каждый прокси свой token bucket (не чаще раза в DELAY_SEC); на 429/блокировку прокси замедляется и отдыхает.
+Состояние пишется в download_state.json — после перезапуска продолжаем с того же места."""
+import argparse
+import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from requests import Session
+
 from youtube_transcript_api import YouTubeTranscriptApi
 
+from cache import get_transcript_cache
+from corpus import index_transcript
+from transcript import fetch_with_client, get_proxy_list, is_proxy_fault, session_for
+
 IDS_FILE = Path(__file__).parent / "video_ids.txt"
 OUT_DIR = Path(__file__).parent / "transcripts"
-PROXY_FILE = Path(__file__).parent / "proxy_working.txt"
 PROGRESS_FILE = Path(__file__).parent / "progress.txt"  # сюда пишем прогресс — открывай и смотри
-# Чтобы не получить бан: пауза между каждым запросом и длинный перерыв каждые N скачиваний
+STATE_FILE = Path(__file__).parent / "download_state.json"
+# Чтобы не получить бан: на каждый прокси не чаще одного запроса в DELAY_SEC
 DELAY_SEC = 6
-PAUSE_EVERY_N_OK = 15   # после каждых N успешных — длинная пауза
-PAUSE_MINUTES = 3       # минут ждать
+# Блокировка/429: прокси отдыхает COOLDOWN_BASE сек (×2 за каждый провал подряд, до COOLDOWN_MAX) и замедляется вдвое
+COOLDOWN_BASE = 60
+COOLDOWN_MAX = 30 * 60
+MAX_DELAY_SEC = 120
+MAX_ATTEMPTS = 5  # после стольких ошибок видео больше не трогаем
+CHECKPOINT_EVERY_SEC = 10
+
+
+class RouteLimiter:
+    """Token bucket одного маршрута (прокси или напрямую) с AIMD: успех — чуть быстрее, блок — вдвое медленнее."""
+
+    def __init__(self, px: str | None, delay: float):
+        self.px = px
+        self.min_delay = delay
+        self.delay = delay
+        self.next_at = 0.0
+        self.fail_streak = 0
+        self.ok = 0
+        self.err = 0
+
+    def ready_at(self) -> float:
+        return self.next_at
+
+    def take(self, now: float) -> None:
+        self.next_at = max(now, self.next_at) + self.delay
+
+    def on_success(self) -> None:
+        self.ok += 1
+        self.fail_streak = 0
+        self.delay = max(self.min_delay, self.delay - 0.5)
+
+    def on_blocked(self, now: float) -> float:
+        self.err += 1
+        self.fail_streak += 1
+        self.delay = min(MAX_DELAY_SEC, self.delay * 2)
+        cooldown = min(COOLDOWN_BASE * 2 ** (self.fail_streak - 1), COOLDOWN_MAX)
+        self.next_at = now + cooldown
+        return cooldown
+
+
+class Scheduler:
+    """Раздаёт маршруты воркерам: берём тот, у кого токен появится раньше, и ждём его."""
+
+    def __init__(self, routes: list[str | None], delay: float):
+        self.limiters = [RouteLimiter(px, delay) for px in routes]
+        self._lock = threading.Lock()
+
+    def acquire(self) -> RouteLimiter:
+        with self._lock:
+            now = time.monotonic()
+            lim = min(self.limiters, key=RouteLimiter.ready_at)
+            wait = max(0.0, lim.next_at - now)
+            lim.take(now)
+        if wait:
+            time.sleep(wait)
+        return lim
+
+
+def load_state() -> dict[str, dict]:
+    if STATE_FILE.exists():
+        try:
+            return json.loads(STATE_FILE.read_text(encoding="utf-8"))
+        except ValueError:
+            print("download_state.json битый — начинаем заново", flush=True)
+    return {}
+
+
+def save_state(state: dict[str, dict]) -> None:
+    tmp = STATE_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, STATE_FILE)
+
+
+def _routes() -> list[str | None]:
+    """Прокси: 1) HTTP_PROXY/HTTPS_PROXY 2) список transcript.py (YOUTUBE_PROXY, proxies_working_list.txt, proxy_working.txt) 3) напрямую."""
+    px = os.environ.get("HTTPS_PROXY") or os.environ.get("HTTP_PROXY")
+    if px:
+        return [px]
+    return get_proxy_list() or [None]
+
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--delay", type=float, default=DELAY_SEC, help="минимум секунд между запросами через один прокси")
+    parser.add_argument("--workers", type=int, default=0, help="потоков (по умолчанию — по одному на прокси)")
+    parser.add_argument("--direct", action="store_true", help="добавить прямое соединение как ещё один маршрут")
+    args = parser.parse_args()
+
     ids = [s.strip() for s in IDS_FILE.read_text(encoding="utf-8").splitlines() if s.strip()]
     OUT_DIR.mkdir(exist_ok=True)
-    # Прокси: 1) HTTP_PROXY/HTTPS_PROXY 2) иначе proxy_working.txt (найденный check_proxies.py)
-    http_client = None
-    if os.environ.get("HTTP_PROXY") or os.environ.get("HTTPS_PROXY"):
-        http_client = Session()
-        px_http = os.environ.get("HTTP_PROXY")
-        px_https = os.environ.get("HTTPS_PROXY") or px_http
-        if px_http:
-            http_client.proxies["http"] = px_http
-        if px_https:
-            http_client.proxies["https"] = px_https
-        print("Прокси (env):", http_client.proxies, flush=True)
-    elif PROXY_FILE.exists():
-        px = PROXY_FILE.read_text(encoding="utf-8").strip()
-        if px:
-            http_client = Session()
-            http_client.proxies["http"] = http_client.proxies["https"] = px
-            print("Прокси (proxy_working.txt):", px, flush=True)
-    api = YouTubeTranscriptApi(http_client=http_client)
-    ok = skip = err = 0
-    total = len(ids)
-
-    def write_progress(i, vid, status):
-        t = time.strftime("%H:%M:%S", time.localtime())
-        PROGRESS_FILE.write_text(
-            f"Обработано: {i+1}/{total}  |  последнее: {vid}  {status}\n"
-            f"OK: {ok}  skip: {skip}  err: {err}  |  {t}\n",
-            encoding="utf-8",
-        )
-
-    for i, vid in enumerate(ids):
-        out = OUT_DIR / f"{vid}.txt"
-        if out.exists():
-            skip += 1
-            write_progress(i, vid, "(skip)")
+    routes = _routes()
+    if args.direct and None not in routes:
+        routes.append(None)
+    print(f"Маршрутов: {len(routes)} ({', '.join(px or 'direct' for px in routes[:5])}{'…' if len(routes) > 5 else ''})", flush=True)
+    scheduler = Scheduler(routes, args.delay)
+    cache = get_transcript_cache()  # общий с ботом: что уже скачано — не качаем, что скачали — боту пригодится
+
+    state = load_state()
+    lock = threading.Lock()
+    counts = {"ok": 0, "skip": 0, "err": 0, "none": 0}
+    todo = []
+    for vid in ids:
+        st = state.get(vid, {})
+        if st.get("status") in ("ok", "none") or st.get("attempts", 0) >= MAX_ATTEMPTS or (OUT_DIR / f"{vid}.txt").exists():
+            counts["skip"] += 1
             continue
-        try:
-            t = api.fetch(vid, languages=("ru", "en"))
-            text = " ".join(x.text for x in t.snippets)
-            out.write_text(text, encoding="utf-8")
-            ok += 1
-            write_progress(i, vid, "OK")
-            print(f"{i+1}/{total} {vid} OK {len(text)}", flush=True)
-            if ok > 0 and ok % PAUSE_EVERY_N_OK == 0:
-                print(f"--- Пауза {PAUSE_MINUTES} мин (скачано {ok})...", flush=True)
-                time.sleep(PAUSE_MINUTES * 60)
-        except Exception as e:
-            err += 1
-            write_progress(i, vid, f"ERR {type(e).__name__}")
-            print(f"{i+1}/{total} {vid} ERR {type(e).__name__}", flush=True)
-        time.sleep(DELAY_SEC)
-    PROGRESS_FILE.write_text(f"--- Готово: ok={ok} skip={skip} err={err}\n", encoding="utf-8")
-    print(f"--- Готово: ok={ok} skip={skip} err={err}", flush=True)
+        todo.append(vid)
+    total = len(todo)
+    started = time.monotonic()
+    last_checkpoint = started
+    done = 0
+
+    def record(vid: str, status: str, note: str = "") -> None:
+        nonlocal done, last_checkpoint
+        with lock:
+            done += 1
+            counts[status if status in counts else "err"] += 1
+            st = state.setdefault(vid, {"attempts": 0})
+            st["status"] = status
+            st["ts"] = int(time.time())
+            if status == "err":
+                st["attempts"] = st.get("attempts", 0) + 1
+                st["error"] = note
+            elapsed = time.monotonic() - started
+            rate = done / elapsed * 60 if elapsed > 0 else 0.0
+            eta = (total - done) / rate if rate > 0 else 0.0
+            line = (
+                f"Обработано: {done}/{total}  |  последнее: {vid}  {status} {note}\n"
+                f"OK: {counts['ok']}  нет субтитров: {counts['none']}  err: {counts['err']}  skip: {counts['skip']}  |  "
+                f"{rate:.1f} видео/мин, осталось ~{eta:.0f} мин  |  {time.strftime('%H:%M:%S')}\n"
+            )
+            print(f"{done}/{total} {vid} {status} {note}  ({rate:.1f}/мин)", flush=True)
+            if time.monotonic() - last_checkpoint >= CHECKPOINT_EVERY_SEC or done == total:
+                PROGRESS_FILE.write_text(line, encoding="utf-8")
+                save_state(state)
+                last_checkpoint = time.monotonic()
+
+    def work(vid: str) -> None:
+        cached = cache.get(vid)
+        if cached is not None:
+            (OUT_DIR / f"{vid}.txt").write_text(" ".join(text for _, text in cached[0]), encoding="utf-8")
+            record(vid, "ok", "cache")
+            return
+        for _ in range(len(routes)):
+            lim = scheduler.acquire()
+            try:
+                t = fetch_with_client(YouTubeTranscriptApi(http_client=session_for(lim.px)), vid)
+            except Exception as e:
+                if is_proxy_fault(e):
+                    with lock:
+                        cooldown = lim.on_blocked(time.monotonic())
+                    print(f"  {lim.px or 'direct'}: {type(e).__name__}, отдых {cooldown:.0f} с, шаг {lim.delay:.0f} с", flush=True)
+                    continue
+                # Нет субтитров / видео недоступно — повторять бессмысленно
+                with lock:
+                    lim.on_success()
+                cache.put_missing(vid, f"{type(e).__name__}: {e}")
+                record(vid, "none", type(e).__name__)
+                return
+            with lock:
+                lim.on_success()
+            snippets = [(x.start, x.text) for x in t.snippets]
+            cache.put(vid, snippets, t.language_code)
+            index_transcript(vid, snippets)
+            (OUT_DIR / f"{vid}.txt").write_text(" ".join(x.text for x in t.snippets), encoding="utf-8")
+            record(vid, "ok", str(len(t.snippets)))
+            return
+        record(vid, "err", "все маршруты заблокированы")
+
+    workers = args.workers or len(routes)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(work, todo))
+    finally:
+        with lock:
+            save_state(state)
+    elapsed = time.monotonic() - started
+    summary = (
+        f"--- Готово: ok={counts['ok']} нет субтитров={counts['none']} err={counts['err']} skip={counts['skip']} "
+        f"за {elapsed / 60:.1f} мин ({done / elapsed * 60 if elapsed > 0 else 0:.1f} видео/мин)"
+    )
+    PROGRESS_FILE.write_text(summary + "\n", encoding="utf-8")
+    print(summary, flush=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Очередь задач на SQLite (WAL): бот кладёт (video_id, режим, абзацы, чат), воркеры в других процессах забирают.
+Один файл на машину; несколько процессов и воркеров читают/пишут его одновременно. Только в пределах одного хоста:
+WAL держится на общей памяти, на сетевом диске блокировки не работают."""
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from cache import connect
+
+JOBS_DB = Path(os.environ.get("JOBS_DB", Path(__file__).parent / "jobs.sqlite3"))
+# Задача без отметки воркера дольше этого — воркер, видимо, умер; возвращаем в очередь.
+# Живой воркер отмечается (heartbeat) каждые HEARTBEAT_EVERY секунд, сколько бы задача ни шла
+STALE_AFTER = float(os.environ.get("JOB_STALE_SEC", "600"))
+HEARTBEAT_EVERY = STALE_AFTER / 4
+MAX_ATTEMPTS = 3
+# Сколько хранить завершённые задачи (воркеры чистят их раз в час)
+JOB_KEEP_SEC = float(os.environ.get("JOB_KEEP_SEC", str(7 * 24 * 3600)))
+# Сколько задач одного пользователя воркеры ведут одновременно; остальные его задачи ждут, чужие идут вперёд
+JOB_MAX_ACTIVE_PER_USER = int(os.environ.get("JOB_MAX_ACTIVE_PER_USER", "2"))
+
+# Справедливый порядок: у каждой задачи «номер круга» — сколько незавершённых задач того же пользователя
+# поставлено раньше неё. Берём по кругам (как round-robin между пользователями), внутри круга — по времени.
+_ROUND = (
+    "(SELECT COUNT(*) FROM jobs p WHERE p.user_id IS j.user_id AND p.status IN ('queued', 'running') AND p.id < j.id)"
+)
+
+
+@dataclass
+class Job:
+    id: int
+    chat_id: int
+    reply_to: int | None
+    user_id: int | None
+    video_id: str
+    mode: str
+    paragraphs: int
+    attempts: int
+
+
+class JobQueue:
+    def __init__(self, path: Path = JOBS_DB):
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                reply_to INTEGER,
+                user_id INTEGER,
+                video_id TEXT NOT NULL,
+                mode TEXT NOT NULL,
+                paragraphs INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs(user_id, status, id)")
+
+    def enqueue(self, chat_id: int, video_id: str, mode: str, paragraphs: int,
+                reply_to: int | None = None, user_id: int | None = None) -> int:
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO jobs (chat_id, reply_to, user_id, video_id, mode, paragraphs, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, reply_to, user_id, video_id, mode, paragraphs, time.time()),
+            )
+            return cur.lastrowid
+
+    def claim(self, worker: str) -> Job | None:
+        """Атомарно взять следующую задачу по справедливому порядку (между процессами — через BEGIN IMMEDIATE)."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, chat_id, reply_to, user_id, video_id, mode, paragraphs, attempts FROM jobs j "
+                    "WHERE status = 'queued' AND (SELECT COUNT(*) FROM jobs r WHERE r.user_id IS j.user_id AND r.status = 'running') < ? "
+                    f"ORDER BY {_ROUND}, id LIMIT 1",
+                    (JOB_MAX_ACTIVE_PER_USER,),
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    (worker, time.time(), row[0]),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return Job(*row[:7], attempts=row[7] + 1)
+
+    def heartbeat(self, job_id: int, worker: str) -> bool:
+        """Продлить задачу, пока она идёт (started_at — время последней отметки). False — её уже забрали у нас."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET started_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time(), job_id, worker),
+            )
+            return cur.rowcount > 0
+
+    def finish(self, job_id: int, worker: str, error: str | None = None) -> bool:
+        """Закрыть задачу, если она всё ещё за этим воркером. False — её вернули в очередь и ведёт другой."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                ("failed" if error else "done", error, time.time(), job_id, worker),
+            )
+            return cur.rowcount > 0
+
+    def requeue_stale(self) -> tuple[int, list[Job]]:
+        """Вернуть в очередь зависшие задачи умерших воркеров. Вернуть (сколько вернули, задачи, которые после
+        MAX_ATTEMPTS закрыли как failed — их пользователям надо ответить)."""
+        now = time.time()
+        cutoff = now - STALE_AFTER
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, chat_id, reply_to, user_id, video_id, mode, paragraphs, attempts FROM jobs "
+                    "WHERE status = 'running' AND started_at < ? AND attempts >= ?",
+                    (cutoff, MAX_ATTEMPTS),
+                ).fetchall()
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'stale', finished_at = ? "
+                    "WHERE status = 'running' AND started_at < ? AND attempts >= ?",
+                    (now, cutoff, MAX_ATTEMPTS),
+                )
+                cur = self._conn.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND started_at < ?", (cutoff,)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return cur.rowcount, [Job(*row) for row in rows]
+
+    def position(self, job_id: int) -> int:
+        """Сколько задач в очереди впереди при справедливом порядке (0 — следующая)."""
+        with self._lock:
+            return self._conn.execute(
+                f"WITH q AS (SELECT id, {_ROUND} AS round FROM jobs j WHERE status = 'queued') "
+                "SELECT COUNT(*) FROM q, q AS me WHERE me.id = ? AND (q.round < me.round OR (q.round = me.round AND q.id < me.id))",
+                (job_id,),
+            ).fetchone()[0]
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def purge(self, older_than: float = JOB_KEEP_SEC) -> int:
+        """Удалить старые завершённые задачи, чтобы файл не рос."""
+        with self._lock:
+            # finished_at нет у задач, закрытых по таймауту старой версией, — для них берём created_at
+            cur = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND COALESCE(finished_at, created_at) < ?",
+                (time.time() - older_than,),
+            )
+            return cur.rowcount
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+"""Вызовы OpenAI: выжимка и оглавление. Один AsyncOpenAI на процесс, не больше OPENAI_CONCURRENCY запросов сразу."""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections.abc import AsyncIterator
+
+from cache import get_result_cache, result_key
+from metrics import openai_request_seconds, openai_tokens
+from toc import sec_to_mmss
+
+OPENAI_MODEL = "gpt-4o-mini"
+# Меняй при правке промптов — иначе из кэша вернутся ответы на старый промпт
+PROMPT_VERSION = "2"
+# Лимит транскрипта для LLM в токенах (контекст); раньше — 12 000 символов
+TRANSCRIPT_MAX_TOKENS = int(os.environ.get("TRANSCRIPT_MAX_TOKENS", "4000"))
+# Лимит одного фрагмента в запросе оглавления (токены); раньше — 1500 символов
+TOC_SEGMENT_MAX_TOKENS = int(os.environ.get("TOC_SEGMENT_MAX_TOKENS", "500"))
+# Сколько запросов к OpenAI держать одновременно на процесс
+OPENAI_CONCURRENCY = int(os.environ.get("OPENAI_CONCURRENCY", "8"))
+
+# Map-reduce для длинных видео: транскрипт длиннее SINGLE_PASS_TOKENS режем на куски по CHUNK_TOKENS,
+# куски конспектируем параллельно (не больше MAP_CONCURRENCY на одно видео), конспекты сводим в выжимку
+CHARS_PER_TOKEN = 3
+TRUNCATE_CHARS_PER_TOKEN = 8
+SINGLE_PASS_TOKENS = TRANSCRIPT_MAX_TOKENS
+CHUNK_TOKENS = int(os.environ.get("SUMMARY_CHUNK_TOKENS", "3000"))
+MAP_CONCURRENCY = int(os.environ.get("SUMMARY_MAP_CONCURRENCY", "4"))
+
+DEFAULT_PARAGRAPHS = 2
+
+log = logging.getLogger(__name__)
+
+_client = None
+_semaphore: asyncio.Semaphore | None = None
+_encoding = None  # токенизатор tiktoken; False — недоступен, считаем по символам
+
+
+def get_openai():
+    """Общий AsyncOpenAI (keep-alive пул соединений внутри). None, если нет OPENAI_API_KEY."""
+    global _client
+    if _client is None:
+        key = os.environ.get("OPENAI_API_KEY")
+        if not key:
+            return None
+        from openai import AsyncOpenAI
+
+        _client = AsyncOpenAI(api_key=key)
+    return _client
+
+
+def _limit() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(OPENAI_CONCURRENCY)
+    return _semaphore
+
+
+def _get_encoding():
+    """Токенизатор модели (tiktoken, если установлен и словарь доступен), иначе None."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+        except ImportError:
+            _encoding = False
+        except Exception as e:
+            # Словарь качается с сервера OpenAI при первом вызове — без сети считаем по символам
+            log.warning("tiktoken недоступен (%s), токены считаем по символам", type(e).__name__)
+            _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов: точно через tiktoken, без него — оценка (~3 символа на токен для русского и английского)."""
+    enc = _get_encoding()
+    if enc is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, marker: str = "") -> str:
+    """Обрезать текст до max_tokens токенов (с marker в конце, если обрезали)."""
+    enc = _get_encoding()
+    if enc is None:
+        limit = max_tokens * CHARS_PER_TOKEN
+        return text if len(text) <= limit else text[:limit] + marker
+    # Кодируем только начало: токен редко длиннее 8 символов, а целиком многочасовой транскрипт токенизировать дорого
+    head = text[:max_tokens * TRUNCATE_CHARS_PER_TOKEN]
+    ids = enc.encode(head, disallowed_special=())
+    if len(ids) > max_tokens:
+        return enc.decode(ids[:max_tokens]) + marker
+    return text if len(head) == len(text) else head + marker
+
+
+def split_snippets(snippets: list[tuple[float, str]], max_tokens: int) -> list[tuple[float, float, str]]:
+    """Разбить сниппеты на куски не больше max_tokens, не разрывая сниппет. Вернуть [(start, end, text)]."""
+    chunks: list[tuple[float, float, str]] = []
+    buf: list[str] = []
+    buf_tokens = 0
+    start = end = 0.0
+    for sec, text in snippets:
+        t = count_tokens(text)
+        if buf and buf_tokens + t > max_tokens:
+            chunks.append((start, end, " ".join(buf)))
+            buf, buf_tokens = [], 0
+        if not buf:
+            start = sec
+        buf.append(text)
+        buf_tokens += t
+        end = sec
+    if buf:
+        chunks.append((start, end, " ".join(buf)))
+    return chunks
+
+
+def _count_usage(usage) -> None:
+    if usage is not None:
+        openai_tokens.inc(usage.prompt_tokens, type="prompt")
+        openai_tokens.inc(usage.completion_tokens, type="completion")
+
+
+async def _complete(messages: list[dict], max_tokens: int, **kwargs) -> str:
+    client = get_openai()
+    async with _limit():
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            r = await client.chat.completions.create(model=OPENAI_MODEL, messages=messages, max_tokens=max_tokens, **kwargs)
+            outcome = "ok"
+        finally:
+            openai_request_seconds.observe(time.monotonic() - started, stream="0", outcome=outcome)
+    _count_usage(r.usage)
+    return (r.choices[0].message.content or "").strip()
+
+
+def _summary_messages(transcript_text: str, num_paragraphs: int) -> list[dict]:
+    transcript_text = truncate_tokens(transcript_text, TRANSCRIPT_MAX_TOKENS, "\n[... обрезано ...]")
+    num_str = str(num_paragraphs)
+    parts = ["О чём видео, основная тема.", "Главные выводы, советы или идеи."]
+    for i in range(3, num_paragraphs + 1):
+        parts.append("Дополнительные важные моменты.")
+    prompt = f"""Кратко суммаризуй содержание видео по транскрипту. Ответ строго в {num_str} абзацев:
+""" + "\n".join(f"{i}) {parts[i-1]}" for i in range(1, num_paragraphs + 1)) + """
+
+Транскрипт:
+"""
+    return [
+        {"role": "system", "content": f"Ты делаешь краткие выжимки видео. Пиши только {num_str} абзаца(ов), без заголовков и списков."},
+        {"role": "user", "content": prompt + transcript_text},
+    ]
+
+
+def _summary_max_tokens(num_paragraphs: int) -> int:
+    return min(500 + (num_paragraphs - 2) * 150, 1000)
+
+
+async def _complete_stream(messages: list[dict], max_tokens: int) -> AsyncIterator[str]:
+    """Ответ модели по кускам (stream=True). Слот семафора занят, пока идёт поток."""
+    client = get_openai()
+    async with _limit():
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            stream = await client.chat.completions.create(
+                model=OPENAI_MODEL, messages=messages, max_tokens=max_tokens, stream=True,
+                stream_options={"include_usage": True},
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                _count_usage(chunk.usage)
+            outcome = "ok"
+        finally:
+            openai_request_seconds.observe(time.monotonic() - started, stream="1", outcome=outcome)
+
+
+async def summarize_with_openai(transcript_text: str, num_paragraphs: int = DEFAULT_PARAGRAPHS) -> str:
+    """Саммари на num_paragraphs абзацев через OpenAI."""
+    cache = get_result_cache()
+    ck = summary_key(transcript_text, num_paragraphs)
+    cached = cache.get(ck)
+    if cached is not None:
+        return cached
+    if get_openai() is None:
+        return "Не задан OPENAI_API_KEY."
+    try:
+        summary = await _complete(_summary_messages(transcript_text, num_paragraphs), _summary_max_tokens(num_paragraphs))
+    except Exception as e:
+        return f"Ошибка саммари: {e!s}"
+    if summary:
+        cache.put(ck, summary)
+    return summary
+
+
+async def _summarize_chunk(start: float, end: float, text: str, sem: asyncio.Semaphore) -> str:
+    """Map: конспект одного куска транскрипта (кэшируется отдельно — пригодится для любого числа абзацев)."""
+    # В кэше — конспект без таймкодов: тот же текст в другом месте видео (или в другом видео) получит свои
+    cache = get_result_cache()
+    ck = result_key("chunk_note", OPENAI_MODEL, PROMPT_VERSION, 0, text)
+    note = cache.get(ck)
+    if note is None:
+        async with sem:
+            note = await _complete(
+                [
+                    {"role": "system", "content": "Ты конспектируешь фрагменты длинного видео. Только факты и мысли из текста, без вступлений."},
+                    {"role": "user", "content": "Перескажи этот фрагмент транскрипта в 4–8 предложениях: ключевые мысли, выводы, примеры.\n\n" + text},
+                ],
+                max_tokens=400,
+            )
+        if not note:
+            return ""
+        cache.put(ck, note)
+    return f"[{sec_to_mmss(start)}–{sec_to_mmss(end)}] {note}"
+
+
+async def _merge_notes(notes: list[str], sem: asyncio.Semaphore) -> str:
+    """Промежуточный reduce: сжать несколько конспектов подряд в один (для многочасовых видео)."""
+    joined = "\n\n".join(notes)
+    cache = get_result_cache()
+    ck = result_key("merge", OPENAI_MODEL, PROMPT_VERSION, 0, joined)
+    cached = cache.get(ck)
+    if cached is not None:
+        return cached
+    async with sem:
+        merged = await _complete(
+            [
+                {"role": "system", "content": "Ты сводишь конспекты частей видео. Сохраняй таймкоды в квадратных скобках и порядок."},
+                {"role": "user", "content": "Сожми эти конспекты идущих подряд частей видео в один конспект на 6–10 предложений.\n\n" + joined},
+            ],
+            max_tokens=600,
+        )
+    if merged:
+        cache.put(ck, merged)
+    return merged
+
+
+async def _reduce_to_notes(snippets: list[tuple[float, str]]) -> str:
+    """Map-reduce до текста, который влезает в один запрос: конспекты кусков, при нужде сведённые группами."""
+    sem = asyncio.Semaphore(MAP_CONCURRENCY)
+    # Токенизация длинного текста — сотни миллисекунд CPU, поэтому не на event loop
+    chunks = await asyncio.to_thread(split_snippets, snippets, CHUNK_TOKENS)
+    notes = list(await asyncio.gather(*(_summarize_chunk(a, b, text, sem) for a, b, text in chunks)))
+    # Конспекты всё ещё не влезают в один запрос — сводим группами, пока не влезут
+    while len(notes) > 1:
+        sizes = await asyncio.to_thread(lambda: [count_tokens(note) for note in notes])
+        if sum(sizes) <= SINGLE_PASS_TOKENS:
+            break
+        groups: list[list[str]] = [[]]
+        group_tokens = 0
+        for note, t in zip(notes, sizes):
+            if groups[-1] and group_tokens + t > CHUNK_TOKENS:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(note)
+            group_tokens += t
+        if len(groups) == len(notes):
+            groups = [notes[i:i + 2] for i in range(0, len(notes), 2)]
+        notes = list(await asyncio.gather(*(_merge_notes(g, sem) for g in groups)))
+    return "\n\n".join(notes)
+
+
+async def summarize_snippets(snippets: list[tuple[float, str]], num_paragraphs: int = DEFAULT_PARAGRAPHS) -> str:
+    """Выжимка по сниппетам: короткий транскрипт — одним запросом, длинный — map-reduce по кускам."""
+    transcript_text = " ".join(text for _, text in snippets)
+    if await asyncio.to_thread(count_tokens, transcript_text) <= SINGLE_PASS_TOKENS:
+        return await summarize_with_openai(transcript_text, num_paragraphs)
+    cache = get_result_cache()
+    ck = summary_key(transcript_text, num_paragraphs)
+    cached = cache.get(ck)
+    if cached is not None:
+        return cached
+    if get_openai() is None:
+        return "Не задан OPENAI_API_KEY."
+    try:
+        summary = await summarize_with_openai(await _reduce_to_notes(snippets), num_paragraphs)
+    except Exception as e:
+        return f"Ошибка саммари: {e!s}"
+    if summary and not summary.startswith("Ошибка саммари"):
+        cache.put(ck, summary)
+    return summary
+
+
+async def stream_summary(snippets: list[tuple[float, str]], num_paragraphs: int = DEFAULT_PARAGRAPHS) -> AsyncIterator[str]:
+    """То же, что summarize_snippets, но кусками по мере генерации (для длинных видео стримится только reduce).
+    Из кэша отдаёт весь ответ одним куском. Ошибки пробрасывает — их показывает вызывающий."""
+    transcript_text = " ".join(text for _, text in snippets)
+    cache = get_result_cache()
+    ck = summary_key(transcript_text, num_paragraphs)
+    cached = cache.get(ck)
+    if cached is not None:
+        yield cached
+        return
+    if get_openai() is None:
+        yield "Не задан OPENAI_API_KEY."
+        return
+    source = transcript_text
+    if await asyncio.to_thread(count_tokens, transcript_text) > SINGLE_PASS_TOKENS:
+        source = await _reduce_to_notes(snippets)
+    parts: list[str] = []
+    async for delta in _complete_stream(_summary_messages(source, num_paragraphs), _summary_max_tokens(num_paragraphs)):
+        parts.append(delta)
+        yield delta
+    summary = "".join(parts).strip()
+    if summary:
+        cache.put(ck, summary)
+
+
+TOC_MAX_TOKENS = 800
+
+
+def _toc_messages(segments: list[tuple[float, str]]) -> list[dict]:
+    parts = [truncate_tokens(text, TOC_SEGMENT_MAX_TOKENS, "...") for _, text in segments]
+    n = len(segments)
+    prompt = f"""По транскрипту ниже даны {n} фрагментов видео по порядку.
+Для каждого фрагмента напиши одну короткую строку (3–10 слов) — о чём речь.
+Только {n} строк, по одной на фрагмент, в том же порядке. Без нумерации, без таймкодов.
+
+""" + "\n\n---\n\n".join(parts)
+    return [
+        {"role": "system", "content": f"Ты составляешь оглавление видео. Ответ: {n} строк, только описание каждого фрагмента."},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def parse_toc_lines(raw: str, n: int) -> list[str]:
+    """Ровно n строк оглавления из ответа модели (недостающие — прочерк)."""
+    lines = [ln.strip() for ln in raw.split("\n") if ln.strip()][:n]
+    while len(lines) < n:
+        lines.append("—")
+    return lines
+
+
+def summary_body(transcript_text: str, num_paragraphs: int) -> dict:
+    """Тело запроса /v1/chat/completions для выжимки (для пакетной обработки)."""
+    return {"model": OPENAI_MODEL, "messages": _summary_messages(transcript_text, num_paragraphs), "max_tokens": _summary_max_tokens(num_paragraphs)}
+
+
+def toc_body(segments: list[tuple[float, str]]) -> dict:
+    """Тело запроса /v1/chat/completions для оглавления (для пакетной обработки)."""
+    return {"model": OPENAI_MODEL, "messages": _toc_messages(segments), "max_tokens": TOC_MAX_TOKENS}
+
+
+async def complete_body(body: dict) -> str:
+    """Выполнить тело запроса из summary_body/toc_body через общий клиент (под общим семафором)."""
+    return await _complete(body["messages"], body["max_tokens"])
+
+
+def toc_key(segments: list[tuple[float, str]]) -> str:
+    return result_key("toc", OPENAI_MODEL, PROMPT_VERSION, len(segments), "\n---\n".join(text for _, text in segments))
+
+
+def summary_key(transcript_text: str, num_paragraphs: int) -> str:
+    return result_key("summary", OPENAI_MODEL, PROMPT_VERSION, num_paragraphs, transcript_text)
+
+
+async def make_toc_with_openai(segments: list[tuple[float, str]]) -> list[str]:
+    """По N сегментам (start_sec, text) вернуть N строк — краткое описание каждого (без таймкода)."""
+    cache = get_result_cache()
+    ck = toc_key(segments)
+    cached = cache.get(ck)
+    if cached is not None:
+        return cached
+    if get_openai() is None:
+        return [f"Не задан OPENAI_API_KEY."] * len(segments)
+    try:
+        raw = await _complete(_toc_messages(segments), max_tokens=TOC_MAX_TOKENS)
+        lines = parse_toc_lines(raw, len(segments))
+        cache.put(ck, lines)
+        return lines
+    except Exception as e:
+        return [f"Ошибка оглавления: {e!s}"]
+
+
+def _parse_combined(raw: str, num_segments: int) -> tuple[list[str] | None, str | None]:
+    """Разобрать JSON {"toc": [...], "summary": [...]}. Невалидная секция — None (по ней будет отдельный запрос)."""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return None, None
+    if not isinstance(data, dict):
+        return None, None
+    toc = data.get("toc")
+    if not (isinstance(toc, list) and len(toc) >= num_segments and all(isinstance(x, str) and x.strip() for x in toc)):
+        toc = None
+    else:
+        toc = [x.strip() for x in toc[:num_segments]]
+    paragraphs = data.get("summary")
+    if isinstance(paragraphs, str):
+        paragraphs = [paragraphs]
+    if isinstance(paragraphs, list) and paragraphs and all(isinstance(x, str) for x in paragraphs):
+        summary = "\n\n".join(p.strip() for p in paragraphs if p.strip()) or None
+    else:
+        summary = None
+    return toc, summary
+
+
+async def summarize_and_toc(
+    segments: list[tuple[float, str]], transcript_text: str, num_paragraphs: int = DEFAULT_PARAGRAPHS
+) -> tuple[list[str], str]:
+    """Оглавление и выжимка одним запросом (JSON): транскрипт уходит в модель один раз, а не дважды.
+    Секцию, которая пришла битой, добираем отдельным запросом (make_toc_with_openai / summarize_with_openai).
+    Ответы кладутся в кэш под теми же ключами, что и у раздельных вызовов."""
+    cache = get_result_cache()
+    tk, sk = toc_key(segments), summary_key(transcript_text, num_paragraphs)
+    toc, summary = cache.get(tk), cache.get(sk)
+    if (toc is None or summary is None) and get_openai() is not None:
+        body = "\n\n".join(f"--- Фрагмент {i} ---\n{text}" for i, (_, text) in enumerate(segments, 1))
+        body = truncate_tokens(body, TRANSCRIPT_MAX_TOKENS, "\n[... обрезано ...]")
+        prompt = f"""Ниже транскрипт видео, разбитый на {len(segments)} фрагментов по порядку.
+Верни JSON-объект с двумя полями:
+"toc": массив из {len(segments)} строк — для каждого фрагмента по порядку одна короткая строка (3–10 слов), о чём речь, без нумерации и таймкодов;
+"summary": массив из {num_paragraphs} абзацев краткой выжимки всего видео: 1) о чём видео, основная тема; 2) главные выводы, советы или идеи; остальные — дополнительные важные моменты.
+
+""" + body
+        try:
+            raw = await _complete(
+                [
+                    {"role": "system", "content": "Ты составляешь оглавление и краткую выжимку видео. Отвечай только JSON."},
+                    {"role": "user", "content": prompt},
+                ],
+                max_tokens=800 + _summary_max_tokens(num_paragraphs),
+                response_format={"type": "json_object"},
+            )
+            new_toc, new_summary = _parse_combined(raw, len(segments))
+        except Exception as e:
+            log.warning("summarize_and_toc: %s", type(e).__name__)
+            new_toc = new_summary = None
+        if toc is None and new_toc is not None:
+            toc = new_toc
+            cache.put(tk, toc)
+        if summary is None and new_summary is not None:
+            summary = new_summary
+            cache.put(sk, summary)
+    if toc is None or summary is None:
+        log.info("summarize_and_toc: добираем отдельно (toc=%s, summary=%s)", toc is not None, summary is not None)
+        toc_task = make_toc_with_openai(segments) if toc is None else None
+        summary_task = summarize_with_openai(transcript_text, num_paragraphs) if summary is None else None
+        results = await asyncio.gather(*(t for t in (toc_task, summary_task) if t is not None))
+        if toc_task is not None:
+            toc = results.pop(0)
+        if summary_task is not None:
+            summary = results.pop(0)
+    return toc, summary
+
+
+ASK_MAX_TOKENS = 600
+
+
+async def answer_question(question: str, fragments: list[str]) -> str:
+    """Ответ на вопрос только по найденным фрагментам транскриптов (а не по целым видео); ссылки — номерами [1], [2]."""
+    body = "\n\n".join(f"[{i}] {truncate_tokens(text, TOC_SEGMENT_MAX_TOKENS, '...')}" for i, text in enumerate(fragments, 1))
+    cache = get_result_cache()
+    ck = result_key("ask", OPENAI_MODEL, PROMPT_VERSION, len(fragments), question + "\n---\n" + body)
+    cached = cache.get(ck)
+    if cached is not None:
+        return cached
+    if get_openai() is None:
+        return "Не задан OPENAI_API_KEY."
+    try:
+        answer = await _complete(
+            [
+                {"role": "system", "content": "Ты отвечаешь на вопросы по фрагментам транскриптов видео. Используй только их; "
+                                              "если ответа во фрагментах нет — так и скажи. После утверждений ставь номер фрагмента: [2]."},
+                {"role": "user", "content": f"Вопрос: {question}\n\nФрагменты:\n\n{body}"},
+            ],
+            max_tokens=ASK_MAX_TOKENS,
+        )
+    except Exception as e:
+        return f"Ошибка ответа: {e!s}"
+    if answer:
+        cache.put(ck, answer)
+    return answer
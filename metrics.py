@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Метрики в текстовом формате Prometheus (без внешних зависимостей) и trace ID запроса в логах.
+Счётчики и гистограммы — потокобезопасные, обновляются и из asyncio, и из пулов потоков."""
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from contextlib import contextmanager
+
+PREFIX = "ytbot_"
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+
+_registry: list = []
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = labels
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v:g}" for k, v in items]
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = labels
+        self.buckets = buckets
+        self._values: dict[tuple[str, ...], list] = {}  # ключ → [счётчики корзин..., сумма, количество]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, row in items:
+            for bound, n in zip(self.buckets, row):
+                out.append(self.name + "_bucket" + _labels(self.labelnames, key, 'le="%g"' % bound) + f" {n}")
+            out.append(self.name + "_bucket" + _labels(self.labelnames, key, 'le="+Inf"') + f" {row[-1]}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {row[-2]:.6f}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {row[-1]}")
+        return out
+
+
+class Gauge:
+    """Значение считается в момент запроса /metrics: fn() → число."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        self.name = PREFIX + name
+        self.help = help
+        self.fn = fn
+        _registry.append(self)
+
+    def render(self) -> list[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value:g}"]
+
+
+def render() -> bytes:
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+async def metrics_handler(headers: dict[str, str], body: bytes) -> tuple[int, str, bytes]:
+    """GET /metrics для webserver.WebServer (и в боте, и в воркерах)."""
+    return 200, "text/plain; version=0.0.4; charset=utf-8", render()
+
+
+# Всё, что нужно понять, где тормозит: прокси/YouTube или OpenAI
+transcript_fetch_seconds = Histogram("transcript_fetch_seconds", "Одна попытка загрузки субтитров", ("route", "outcome"))  # route: direct, свой прокси host:port или web
+proxy_failures = Counter("proxy_failures_total", "Ошибки по вине прокси (сеть, блокировка YouTube)", ("route",))
+timeouts = Counter("timeouts_total", "Таймауты по этапам", ("stage",))
+cache_requests = Counter("cache_requests_total", "Обращения к кэшам", ("cache", "result"))
+stage_seconds = Histogram("stage_seconds", "Этапы обработки видео (с кэшем и ожиданием чужого запроса)", ("stage",))
+handle_seconds = Histogram("handle_seconds", "Полная обработка ссылки", ("mode", "outcome"))
+openai_request_seconds = Histogram("openai_request_seconds", "Один запрос к OpenAI", ("stream", "outcome"))
+openai_tokens = Counter("openai_tokens_total", "Токены OpenAI", ("type",))
+corpus_search_seconds = Histogram("corpus_search_seconds", "Поиск по корпусу транскриптов (/ask)", ())
+
+
+def route_label(px: str | None) -> str:
+    """Метка маршрута без логина и пароля прокси."""
+    if px is None:
+        return "direct"
+    return px.rsplit("@", 1)[-1].split("://", 1)[-1]
+
+
+# Trace ID: один на обработку ссылки, попадает в каждую строку лога этой обработки (в т.ч. из потоков transcript.py)
+trace_id: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+
+
+def new_trace() -> str:
+    tid = uuid.uuid4().hex[:12]
+    trace_id.set(tid)
+    return tid
+
+
+def install_trace_logging() -> None:
+    """Добавить %(trace_id)s во все записи логов (вызывать до logging.basicConfig)."""
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "_with_trace", False):
+        return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.trace_id = trace_id.get()
+        return record
+
+    record_factory._with_trace = True
+    logging.setLogRecordFactory(record_factory)
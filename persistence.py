@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Настройки пользователей (режим, число абзацев, последние видео) в SQLite — переживают рестарт и деплой.
+Подключается к python-telegram-bot как persistence: PTB сам копит изменённые user_data и раз в
+PERSISTENCE_FLUSH_SEC отдаёт их сюда, мы пишем всю пачку одной транзакцией.
+Пользователей не грузим при старте: запись читается при первом апдейте от человека (refresh_user_data),
+поэтому старт и память не зависят от того, сколько их всего. Несколько процессов бота делят один файл (WAL):
+перед каждым апдейтом сверяем версию записи и подтягиваем то, что сохранил другой процесс."""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from cache import connect
+
+BOT_STATE_DB = Path(os.environ.get("BOT_STATE_DB", Path(__file__).parent / "bot_state.sqlite3"))
+# Как часто PTB сбрасывает изменённые настройки в базу
+PERSISTENCE_FLUSH_SEC = float(os.environ.get("PERSISTENCE_FLUSH_SEC", "10"))
+
+log = logging.getLogger(__name__)
+
+
+class UserStore:
+    """Таблица user_id → компактный JSON user_data + время последней записи (версия)."""
+
+    def __init__(self, path: Path = BOT_STATE_DB):
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL) WITHOUT ROWID"
+        )
+
+    def get(self, user_id: int) -> tuple[dict, float] | None:
+        with self._lock:
+            row = self._conn.execute("SELECT data, updated_at FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        try:
+            return json.loads(row[0]), row[1]
+        except ValueError:
+            log.warning("persistence: битая запись пользователя %s", user_id)
+            return None
+
+    def put_many(self, items: dict[int, dict]) -> float:
+        now = time.time()
+        rows = [(uid, json.dumps(data, ensure_ascii=False, separators=(",", ":")), now) for uid, data in items.items()]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO users (user_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return now
+
+    def delete(self, user_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+
+class SqlitePersistence(BasePersistence):
+    """Только user_data; chat_data, bot_data, callback_data и диалоги боту не нужны."""
+
+    def __init__(self, path: Path = BOT_STATE_DB, update_interval: float = PERSISTENCE_FLUSH_SEC):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = UserStore(path)
+        self._versions: dict[int, float] = {}  # какую версию записи видел этот процесс
+        self._pending: dict[int, dict] = {}
+        self._writer: asyncio.Task | None = None
+
+    async def get_user_data(self) -> dict[int, dict]:
+        return {}  # по одному, при первом апдейте — см. refresh_user_data
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._pending:
+            return  # у нас изменения новее, чем в базе
+        row = await asyncio.to_thread(self.store.get, user_id)
+        if row is None or user_id in self._pending:
+            return  # пока читали, этот процесс успел изменить запись
+        data, version = row
+        if version > self._versions.get(user_id, 0.0):
+            user_data.clear()
+            user_data.update(data)
+            self._versions[user_id] = version
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # PTB зовёт это для всех изменённых пользователей разом — собираем их в одну транзакцию
+        self._pending[user_id] = data
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        await asyncio.sleep(0)
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        try:
+            version = await asyncio.to_thread(self.store.put_many, batch)
+        except sqlite3.Error as e:
+            log.warning("persistence: не удалось сохранить %d пользователей: %s", len(batch), e)
+            for uid, data in batch.items():
+                self._pending.setdefault(uid, data)
+            return
+        for uid in batch:
+            self._versions[uid] = version
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+        self._versions.pop(user_id, None)
+        await asyncio.to_thread(self.store.delete, user_id)
+
+    async def flush(self) -> None:
+        if self._writer is not None:
+            await self._writer
+        if self._pending:
+            await self._write_pending()
+
+    # Остальное PTB требует реализовать, но мы это не храним
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""Обработка одного видео: субтитры → оглавление и/или выжимка → сообщения в чат.
+Не зависит от того, кто прислал ссылку: бот отвечает через update.message.reply_text, воркер очереди — через bot.send_message."""
+import asyncio
+import logging
+import os
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from cache import get_result_cache, get_transcript_cache
+from compact import maybe_compact
+from llm import (
+    DEFAULT_PARAGRAPHS,
+    OPENAI_MODEL,
+    SINGLE_PASS_TOKENS,
+    count_tokens,
+    get_openai,
+    make_toc_with_openai,
+    stream_summary,
+    summarize_and_toc,
+    summarize_snippets,
+)
+from metrics import handle_seconds, stage_seconds, timeouts
+from singleflight import SingleFlight
+from toc import format_toc, toc_segments
+from transcript import fetch_transcript_timestamped_async, proxy_pool, session_for
+
+# Стриминг выжимки: правим сообщение по мере генерации, не чаще раза в STREAM_EDIT_INTERVAL сек
+SUMMARY_STREAMING = os.environ.get("SUMMARY_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+TELEGRAM_MAX_LEN = 4096
+
+# Выжимка и оглавление одним запросом к LLM (для видео, что влезают в один запрос)
+COMBINED_LLM = os.environ.get("COMBINED_LLM", "0") == "1"
+
+# Прогрев при старте: не дольше WARMUP_TIMEOUT сек; keep-alive к YouTube — через столько лучших прокси (+ напрямую)
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "20"))
+WARMUP_ROUTES = 2
+
+log = logging.getLogger(__name__)
+
+# reply(text, parse_mode=None) → отправленное сообщение (с edit_text/reply_text)
+Reply = Callable[..., Awaitable]
+
+
+async def build_toc_message(snippets: list[tuple[float, str]], video_id: str) -> str:
+    """По списку (start_sec, text) и video_id собрать HTML-сообщение с оглавлением (кликабельные ссылки)."""
+    if not snippets:
+        return ""
+    segments = toc_segments(snippets)
+    descriptions = await make_toc_with_openai(segments)
+    return format_toc(segments, descriptions, video_id)
+
+
+async def build_toc_and_summary(snippets: list[tuple[float, str]], video_id: str, num_paragraphs: int) -> tuple[str, str]:
+    """Оглавление (HTML) и выжимка одним запросом к LLM (COMBINED_LLM)."""
+    segments = toc_segments(snippets)
+    transcript_text = " ".join(text for _, text in snippets)
+    descriptions, summary = await summarize_and_toc(segments, transcript_text, num_paragraphs)
+    return format_toc(segments, descriptions, video_id), summary
+
+
+# Одинаковые запросы из группы (та же ссылка от многих) делят одну загрузку и один вызов LLM
+_inflight = SingleFlight()
+
+
+async def _fetch_compacted(video_id: str):
+    """Сниппеты, сжатые перед LLM (compact.py); в кэше транскриптов лежат исходные."""
+    snippets, err = await fetch_transcript_timestamped_async(video_id)
+    if snippets:
+        snippets = await asyncio.to_thread(maybe_compact, snippets)
+    return snippets, err
+
+
+async def _fetch_snippets_shared(video_id: str):
+    with stage_seconds.time(stage="transcript"):
+        return await _inflight.do(("transcript", video_id), lambda: _fetch_compacted(video_id))
+
+
+async def _build_toc_shared(snippets: list[tuple[float, str]], video_id: str) -> str:
+    with stage_seconds.time(stage="toc"):
+        return await _inflight.do(("toc", video_id), lambda: build_toc_message(snippets, video_id))
+
+
+async def _summarize_shared(snippets: list[tuple[float, str]], num_paragraphs: int, video_id: str) -> str:
+    with stage_seconds.time(stage="summary"):
+        return await _inflight.do(
+            ("summary", video_id, num_paragraphs),
+            lambda: summarize_snippets(snippets, num_paragraphs),
+        )
+
+
+def split_message(text: str, limit: int = TELEGRAM_MAX_LEN) -> list[str]:
+    """Порезать текст на части не длиннее limit: по абзацам, строкам, пробелам — что найдётся ближе к концу."""
+    parts = []
+    while len(text) > limit:
+        cut = max(text.rfind(sep, 0, limit) for sep in ("\n\n", "\n", " "))
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return parts
+
+
+async def _edit_long(message, text: str, parse_mode: str | None = None) -> None:
+    """Заменить текст message; что не влезло в 4096 символов — отправить следующими сообщениями."""
+    first, *rest = split_message(text)
+    try:
+        await message.edit_text(first, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    for part in rest:
+        await message.reply_text(part, parse_mode=parse_mode)
+
+
+async def _deliver(message, result: Awaitable[str], prefix: str = "", parse_mode: str | None = None) -> None:
+    """Дождаться result и заменить им текст заглушки message. Ошибка одной части не мешает другой."""
+    try:
+        text = prefix + await result
+    except Exception as e:
+        log.exception("deliver: %s", type(e).__name__)
+        text, parse_mode = prefix + f"Ошибка: {e!s}", None
+    await _edit_long(message, text, parse_mode=parse_mode)
+
+
+async def _stream_to_message(message, deltas: AsyncIterator[str], prefix: str = "") -> str:
+    """Читать поток и править message не чаще STREAM_EDIT_INTERVAL (лимиты Telegram на edit).
+    В конце — полный текст, порезанный по 4096. Вернуть итоговый текст без prefix."""
+    loop = asyncio.get_running_loop()
+    text = ""
+    shown = ""
+    next_edit = loop.time() + STREAM_EDIT_INTERVAL
+    try:
+        async for delta in deltas:
+            text += delta
+            now = loop.time()
+            if now < next_edit:
+                continue
+            preview = prefix + text
+            if len(preview) > TELEGRAM_MAX_LEN:
+                preview = preview[: TELEGRAM_MAX_LEN - 1] + "…"
+            if preview != shown:
+                try:
+                    await message.edit_text(preview + " ▌" if len(preview) < TELEGRAM_MAX_LEN - 2 else preview)
+                    shown = preview
+                except RetryAfter as e:
+                    now += e.retry_after
+                except TelegramError as e:
+                    # Превью — не главное: сбой правки (таймаут, сеть) не должен обрывать чтение потока OpenAI
+                    log.warning("stream edit: %s: %s", type(e).__name__, e)
+            next_edit = now + STREAM_EDIT_INTERVAL
+    except Exception as e:
+        log.exception("stream: %s", type(e).__name__)
+        text = text.strip() + f"\n\nОшибка саммари: {e!s}"
+    text = text.strip()
+    await _edit_long(message, prefix + text)
+    return text
+
+
+async def _summarize_streaming(message, snippets: list[tuple[float, str]], num_paragraphs: int, video_id: str, prefix: str) -> None:
+    """Выжимка со стримингом в message. Если такая же выжимка уже идёт у другого — ждём её готовый текст."""
+    key = ("summary", video_id, num_paragraphs)
+    if key in _inflight:
+        await _deliver(message, _summarize_shared(snippets, num_paragraphs, video_id), prefix=prefix)
+        return
+    with stage_seconds.time(stage="summary"):
+        await _inflight.do(key, lambda: _stream_to_message(message, stream_summary(snippets, num_paragraphs), prefix))
+
+
+async def process_video(reply: Reply, video_id: str, mode: str = "summary", num_paragraphs: int = DEFAULT_PARAGRAPHS) -> None:
+    """Сделать оглавление (mode="toc") или оглавление + выжимку и отправить их через reply."""
+    log.info("video %s: %s, %d абз.", video_id, mode, num_paragraphs)
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        outcome = await _process_video(reply, video_id, mode, num_paragraphs)
+    finally:
+        elapsed = time.monotonic() - started
+        handle_seconds.observe(elapsed, mode=mode, outcome=outcome)
+        log.info("video %s: %s за %.1f с", video_id, outcome, elapsed)
+
+
+async def _process_video(reply: Reply, video_id: str, mode: str, num_paragraphs: int) -> str:
+    """Сама обработка; вернуть исход для метрик: ok, timeout, no_transcript."""
+    if mode == "toc":
+        await reply("Скачиваю субтитры и делаю оглавление…")
+        try:
+            result = await asyncio.wait_for(_fetch_snippets_shared(video_id), timeout=90.0)
+        except asyncio.TimeoutError:
+            timeouts.inc(stage="transcript")
+            await reply("Запрос к YouTube занял слишком много времени. Попробуй ещё раз или другую ссылку.")
+            return "timeout"
+        snippets, err_msg = result
+        if not snippets:
+            msg = "У этого видео нет субтитров или они недоступны."
+            if err_msg:
+                msg += f"\n\nПричина: {err_msg}"
+            await reply(msg)
+            return "no_transcript"
+        toc_message = await _build_toc_shared(snippets, video_id)
+        await reply(toc_message, parse_mode="HTML")
+        return "ok"
+
+    # Режим выжимки (2/4/8/10): сначала оглавление, потом выжимка
+    await reply("Скачиваю субтитры, делаю оглавление и выжимку…")
+    try:
+        result = await asyncio.wait_for(_fetch_snippets_shared(video_id), timeout=90.0)
+    except asyncio.TimeoutError:
+        timeouts.inc(stage="transcript")
+        await reply("Запрос к YouTube занял слишком много времени. Попробуй ещё раз или другую ссылку.")
+        return "timeout"
+    snippets, err_msg = result
+    if not snippets:
+        msg = "У этого видео нет субтитров или они недоступны."
+        if err_msg:
+            msg += f"\n\nПричина: {err_msg}"
+        await reply(msg)
+        return "no_transcript"
+    # Оглавление и выжимка — независимые запросы к LLM: идут параллельно, каждый правит своё сообщение.
+    # Заглушки отправляем сразу, чтобы порядок в чате был «оглавление, потом выжимка», кто бы ни успел первым.
+    toc_msg = await reply("Оглавление: готовлю…")
+    summary_msg = await reply("Выжимка: готовлю…")
+    if COMBINED_LLM and await asyncio.to_thread(count_tokens, " ".join(text for _, text in snippets)) <= SINGLE_PASS_TOKENS:
+        combined = asyncio.ensure_future(
+            _inflight.do(("combined", video_id, num_paragraphs), lambda: build_toc_and_summary(snippets, video_id, num_paragraphs))
+        )
+
+        async def part(i: int) -> str:
+            return (await asyncio.shield(combined))[i]
+
+        with stage_seconds.time(stage="combined"):
+            await asyncio.gather(
+                _deliver(toc_msg, part(0), parse_mode="HTML"),
+                _deliver(summary_msg, part(1), prefix="———\n\n"),
+            )
+        return "ok"
+    await asyncio.gather(
+        _deliver(toc_msg, _build_toc_shared(snippets, video_id), parse_mode="HTML"),
+        _summarize_streaming(summary_msg, snippets, num_paragraphs, video_id, prefix="———\n\n")
+        if SUMMARY_STREAMING
+        else _deliver(summary_msg, _summarize_shared(snippets, num_paragraphs, video_id), prefix="———\n\n"),
+    )
+    return "ok"
+
+
+async def warm_up() -> None:
+    """Сделать при старте то, за что иначе платит первый запрос после деплоя: клиент OpenAI с TLS и keep-alive,
+    сессии к YouTube (через лучшие прокси и напрямую), словарь токенизатора, базы кэша. Ошибки не фатальны."""
+    started = time.monotonic()
+
+    async def openai() -> None:
+        client = get_openai()
+        if client is not None:
+            await client.models.retrieve(OPENAI_MODEL)  # заодно проверка ключа
+
+    def youtube(px: str | None) -> None:
+        session_for(px).head("https://www.youtube.com/", timeout=5)
+
+    steps = {
+        "openai": openai(),
+        "tokenizer": asyncio.to_thread(count_tokens, "прогрев"),
+        "cache": asyncio.to_thread(lambda: (get_transcript_cache(), get_result_cache())),
+    }
+    for px in [*proxy_pool.candidates()[:WARMUP_ROUTES], None]:
+        steps[f"youtube {px or 'direct'}"] = asyncio.to_thread(youtube, px)
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*steps.values(), return_exceptions=True), WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning("warm-up: не уложились в %.0f с, стартуем как есть", WARMUP_TIMEOUT)
+        return
+    for name, result in zip(steps, results):
+        if isinstance(result, Exception):
+            log.warning("warm-up %s: %s", name, type(result).__name__)
+    log.info("warm-up: %.2f с", time.monotonic() - started)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Пул прокси для YouTube: живёт весь процесс, помнит успехи и задержки, битые прокси убирает в карантин."""
+import logging
+import os
+import random
+import threading
+import time
+from collections.abc import Callable
+
+# Сглаживание EWMA: чем больше, тем быстрее забываем старое
+EWMA_ALPHA = 0.3
+# Карантин: первый провал — QUARANTINE_BASE сек, дальше ×2 до QUARANTINE_MAX
+QUARANTINE_BASE = 30.0
+QUARANTINE_MAX = 3600.0
+# Как часто перечитывать YOUTUBE_PROXY / файлы и подтягивать свежие прокси с веба (0 — не подтягивать)
+RELOAD_INTERVAL = 60.0
+WEB_REFRESH_INTERVAL = float(os.environ.get("PROXY_WEB_REFRESH_MINUTES", "30")) * 60
+WEB_REFRESH_LIMIT = 50
+# Свежие прокси с веба не проверены — стартуют с меньшим доверием, чем свои
+PRIOR_CONFIGURED = 0.7
+PRIOR_WEB = 0.3
+
+log = logging.getLogger(__name__)
+
+
+class ProxyStats:
+    __slots__ = ("success", "latency", "fail_streak", "quarantined_until", "from_web")
+
+    def __init__(self, prior: float, from_web: bool = False):
+        self.success = prior
+        self.latency: float | None = None
+        self.fail_streak = 0
+        self.quarantined_until = 0.0
+        self.from_web = from_web
+
+    def score(self) -> float:
+        """Доля успехов на секунду ожидания: быстрый и надёжный — первым."""
+        latency = self.latency if self.latency is not None else 5.0
+        return self.success / (1.0 + latency)
+
+
+class ProxyPool:
+    """Порядок попыток — по score; провалившиеся сидят в карантине с экспоненциальным backoff."""
+
+    def __init__(self, load: Callable[[], list[str]], web_refresh_interval: float = WEB_REFRESH_INTERVAL):
+        self._load = load
+        self._lock = threading.Lock()
+        self._stats: dict[str, ProxyStats] = {}
+        self._configured: frozenset[str] = frozenset()
+        self._loaded_at = float("-inf")  # первый candidates() читает список сразу
+        self._web_refresh_interval = web_refresh_interval
+        self._refresher: threading.Thread | None = None
+
+    def _reload_if_stale(self) -> None:
+        now = time.monotonic()
+        # Пустой список тоже кэшируем: без прокси не перечитываем env и файлы на каждый запрос
+        if now - self._loaded_at < RELOAD_INTERVAL:
+            return
+        try:
+            fresh = self._load()
+        except Exception as e:
+            log.warning("proxy pool: не удалось перечитать список: %s", type(e).__name__)
+            self._loaded_at = now  # повторим через RELOAD_INTERVAL, а не на следующем запросе
+            return
+        with self._lock:
+            self._loaded_at = now
+            self._configured = frozenset(fresh)
+            for px in fresh:
+                st = self._stats.get(px)
+                if st is None:
+                    self._stats[px] = ProxyStats(PRIOR_CONFIGURED)
+                elif st.from_web:
+                    st.from_web = False
+            # Свои прокси, убранные из конфига, забываем; веб-прокси живут до следующего обновления
+            keep = set(fresh)
+            for px in [p for p, st in self._stats.items() if not st.from_web and p not in keep]:
+                del self._stats[px]
+
+    def candidates(self) -> list[str]:
+        """Прокси вне карантина, лучшие первыми. Если в карантине все — тот, кто выйдет раньше всех."""
+        self._reload_if_stale()
+        self._ensure_refresher()
+        now = time.monotonic()
+        with self._lock:
+            ready = [(st.score(), px) for px, st in self._stats.items() if st.quarantined_until <= now]
+            if not ready and self._stats:
+                px = min(self._stats, key=lambda p: self._stats[p].quarantined_until)
+                return [px]
+        # Случайный тай-брейк, чтобы новые прокси с одинаковым score не шли всегда в одном порядке
+        ready.sort(key=lambda x: (-x[0], random.random()))
+        return [px for _, px in ready]
+
+    def is_configured(self, px: str) -> bool:
+        """Прокси из конфига (YOUTUBE_PROXY или файлов), а не подобранный с веба."""
+        return px in self._configured
+
+    def report_success(self, px: str, latency: float) -> None:
+        with self._lock:
+            st = self._stats.get(px)
+            if st is None:
+                return
+            st.success = (1 - EWMA_ALPHA) * st.success + EWMA_ALPHA
+            st.latency = latency if st.latency is None else (1 - EWMA_ALPHA) * st.latency + EWMA_ALPHA * latency
+            st.fail_streak = 0
+            st.quarantined_until = 0.0
+
+    def report_failure(self, px: str) -> None:
+        with self._lock:
+            st = self._stats.get(px)
+            if st is None:
+                return
+            st.success = (1 - EWMA_ALPHA) * st.success
+            st.fail_streak += 1
+            delay = min(QUARANTINE_BASE * 2 ** (st.fail_streak - 1), QUARANTINE_MAX)
+            st.quarantined_until = time.monotonic() + delay
+            log.info("proxy pool: %s в карантин на %.0f с (провалов подряд: %d)", px, delay, st.fail_streak)
+
+    def add_web_proxies(self, proxies: list[str]) -> int:
+        """Добавить свежие прокси из сети. Вернуть, сколько новых."""
+        added = 0
+        with self._lock:
+            for px in proxies:
+                if px not in self._stats:
+                    self._stats[px] = ProxyStats(PRIOR_WEB, from_web=True)
+                    added += 1
+            # Веб-прокси, которые так и не заработали, выкидываем, чтобы пул не рос бесконечно
+            for px in [p for p, st in self._stats.items() if st.from_web and st.fail_streak >= 3]:
+                del self._stats[px]
+        return added
+
+    def _ensure_refresher(self) -> None:
+        if self._web_refresh_interval <= 0 or self._refresher is not None:
+            return
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, name="proxy-refresh", daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self) -> None:
+        """Фоном подтягивать свежие прокси из источников check_proxies.py."""
+        try:
+            from check_proxies import fetch_proxies_from_web
+        except ImportError as e:
+            log.warning("proxy pool: обновление с веба выключено (%s)", e)
+            return
+        while True:
+            try:
+                added = self.add_web_proxies(fetch_proxies_from_web(limit=WEB_REFRESH_LIMIT))
+                log.info("proxy pool: с веба добавлено %d прокси", added)
+            except Exception as e:
+                log.warning("proxy pool: обновление с веба: %s", type(e).__name__)
+            time.sleep(self._web_refresh_interval)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Справедливый планировщик обработки видео: очередь на каждого пользователя, раздача по кругу (round-robin),
+лимиты одновременной работы — общий и на пользователя. Кто прислал 30 ссылок, не задерживает остальных:
+их задачи идут через одну с чужими. Если ожидаемое ожидание больше SCHEDULER_SLO_SEC — новую задачу не берём."""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+# Сколько видео обрабатывается одновременно всего и у одного пользователя
+SCHEDULER_MAX_ACTIVE = int(os.environ.get("SCHEDULER_MAX_ACTIVE", "16"))
+SCHEDULER_MAX_ACTIVE_PER_USER = int(os.environ.get("SCHEDULER_MAX_ACTIVE_PER_USER", "2"))
+# Больше стольких задач в очереди от одного пользователя не принимаем
+SCHEDULER_MAX_QUEUED_PER_USER = int(os.environ.get("SCHEDULER_MAX_QUEUED_PER_USER", "20"))
+# Цель по задержке: если по оценке ждать дольше — отказываем сразу, а не держим человека в очереди
+SCHEDULER_SLO_SEC = float(os.environ.get("SCHEDULER_SLO_SEC", "120"))
+# Не чаще раза в столько секунд правим сообщение «в очереди» одного пользователя (лимиты Telegram)
+POSITION_UPDATE_INTERVAL = 3.0
+INITIAL_JOB_SEC = 20.0  # оценка длительности одной задачи, пока нет замеров
+EWMA_ALPHA = 0.2
+
+log = logging.getLogger(__name__)
+
+# on_position(сколько задач впереди) — вызывается, пока задача ждёт в очереди
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class Overloaded(Exception):
+    """Очередь слишком длинная: по оценке ждать wait секунд."""
+
+    def __init__(self, wait: float, reason: str = "slo"):
+        super().__init__(f"{reason}: ~{wait:.0f} s")
+        self.wait = wait
+        self.reason = reason
+
+
+@dataclass(eq=False)
+class _Ticket:
+    user: int
+    started: asyncio.Future
+    on_position: PositionCallback | None
+    position: int = -1
+    notified_at: float = 0.0
+    notify_task: asyncio.Task | None = field(default=None, repr=False)
+
+
+class FairScheduler:
+    def __init__(self, max_active: int = SCHEDULER_MAX_ACTIVE, per_user: int = SCHEDULER_MAX_ACTIVE_PER_USER,
+                 max_queued_per_user: int = SCHEDULER_MAX_QUEUED_PER_USER, slo: float = SCHEDULER_SLO_SEC):
+        self.max_active = max_active
+        self.per_user = per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.slo = slo
+        self._queues: dict[int, deque[_Ticket]] = {}
+        self._ring: deque[int] = deque()  # пользователи с непустой очередью, в порядке обхода
+        self._active: dict[int, int] = {}
+        self._active_total = 0
+        self._queued_total = 0
+        self._avg_job = INITIAL_JOB_SEC
+
+    def estimated_wait(self) -> float:
+        """Сколько ждать новой задаче: очередь × средняя длительность / число параллельных слотов."""
+        ahead = self._queued_total + max(0, self._active_total - self.max_active + 1)
+        return ahead * self._avg_job / self.max_active
+
+    def stats(self) -> dict[str, float]:
+        return {"active": self._active_total, "queued": self._queued_total,
+                "users_waiting": len(self._ring), "avg_job_sec": round(self._avg_job, 1)}
+
+    async def run(self, user: int, fn: Callable[[], Awaitable], on_position: PositionCallback | None = None):
+        """Дождаться очереди пользователя и выполнить fn(). Overloaded — если задачу не берём."""
+        queue = self._queues.get(user)
+        if queue is not None and len(queue) >= self.max_queued_per_user:
+            raise Overloaded(self.estimated_wait(), "user_backlog")
+        wait = self.estimated_wait()
+        if self._queued_total and wait > self.slo:
+            raise Overloaded(wait)
+
+        ticket = _Ticket(user, asyncio.get_running_loop().create_future(), on_position)
+        if queue is None:
+            queue = self._queues[user] = deque()
+            self._ring.append(user)
+        queue.append(ticket)
+        self._queued_total += 1
+        self._dispatch()
+        try:
+            await ticket.started
+        except asyncio.CancelledError:
+            if not ticket.started.done() or ticket.started.cancelled():
+                self._remove(ticket)
+                self._dispatch()
+                raise
+            # Слот уже выдан, но задачу отменили — вернуть его
+            self._release(user, None)
+            raise
+        finally:
+            if ticket.notify_task is not None:
+                ticket.notify_task.cancel()
+
+        started = time.monotonic()
+        try:
+            return await fn()
+        finally:
+            self._release(user, time.monotonic() - started)
+
+    def _release(self, user: int, duration: float | None) -> None:
+        self._active_total -= 1
+        self._active[user] -= 1
+        if not self._active[user]:
+            del self._active[user]
+        if duration is not None:
+            self._avg_job += EWMA_ALPHA * (duration - self._avg_job)
+        self._dispatch()
+
+    def _remove(self, ticket: _Ticket) -> None:
+        queue = self._queues.get(ticket.user)
+        if queue is None or ticket not in queue:
+            return
+        queue.remove(ticket)
+        self._queued_total -= 1
+        if not queue:
+            del self._queues[ticket.user]
+            self._ring.remove(ticket.user)
+
+    def _dispatch(self) -> None:
+        """Раздать свободные слоты по кругу: по одной задаче каждому, у кого не исчерпан лимит."""
+        while self._active_total < self.max_active and self._ring:
+            for _ in range(len(self._ring)):
+                user = self._ring[0]
+                self._ring.rotate(-1)
+                if self._active.get(user, 0) < self.per_user:
+                    break
+            else:
+                break  # у всех ждущих исчерпан личный лимит
+            queue = self._queues[user]
+            ticket = queue.popleft()
+            self._queued_total -= 1
+            if not queue:
+                del self._queues[user]
+                self._ring.remove(user)
+            if ticket.started.done():
+                continue  # ожидание отменили, а из очереди ещё не убрали
+            self._active_total += 1
+            self._active[user] = self._active.get(user, 0) + 1
+            ticket.started.set_result(None)
+        self._notify_positions()
+
+    def _order(self) -> list[_Ticket]:
+        """Ожидаемый порядок запуска: круги по пользователям в порядке обхода (без учёта личных лимитов)."""
+        queues = [self._queues[u] for u in self._ring]
+        order = []
+        for depth in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[depth] for q in queues if depth < len(q))
+        return order
+
+    def _notify_positions(self) -> None:
+        if not any(t.on_position for q in self._queues.values() for t in q):
+            return
+        now = time.monotonic()
+        for pos, ticket in enumerate(self._order()):
+            if ticket.on_position is None or pos == ticket.position:
+                continue
+            if ticket.position >= 0 and now - ticket.notified_at < POSITION_UPDATE_INTERVAL:
+                continue
+            if ticket.notify_task is not None and not ticket.notify_task.done():
+                continue
+            ticket.position = pos
+            ticket.notified_at = now
+            ticket.notify_task = asyncio.create_task(self._notify(ticket, pos))
+
+    @staticmethod
+    async def _notify(ticket: _Ticket, pos: int) -> None:
+        try:
+            await ticket.on_position(pos)
+        except Exception as e:
+            log.debug("scheduler: позиция не отправлена: %s", type(e).__name__)
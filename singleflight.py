@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Склейка одновременных одинаковых запросов: пока задача по ключу идёт, новые ждут её же результат."""
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+log = logging.getLogger(__name__)
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Одна задача на ключ. Отмена/таймаут одного ждущего не трогает остальных;
+    задача отменяется, только когда ушли все ждущие. Результат и исключение получают все."""
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, _Call] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda t, k=key, c=call: self._finish(k, c, t))
+        else:
+            log.info("singleflight: присоединились к %s", key)
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Ключ освобождаем сразу: до колбэка _finish новый запрос иначе присоединился бы к отменённой задаче
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                call.task.cancel()
+
+    def _finish(self, key: Hashable, call: _Call, task: asyncio.Future) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Забрать исключение, если все ждущие уже ушли, — иначе asyncio ругается "never retrieved"
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Оглавление видео: разбивка сниппетов на отрезки и HTML со ссылками на таймкоды."""
+import bisect
+import html
+import math
+import os
+
+# Пунктов оглавления: не меньше TOC_SEGMENTS, для длинных видео — по одному на TOC_SECONDS_PER_SEGMENT, но не больше TOC_MAX_SEGMENTS
+TOC_SEGMENTS = int(os.environ.get("TOC_SEGMENTS", "10"))
+TOC_MAX_SEGMENTS = int(os.environ.get("TOC_MAX_SEGMENTS", "20"))
+TOC_SECONDS_PER_SEGMENT = 600
+# Границу пункта ищем в окне ±TOC_SNAP длины пункта вокруг равномерной отметки — на самой длинной паузе
+TOC_SNAP = 0.25
+
+
+def sec_to_mmss(sec: float) -> str:
+    m = int(sec // 60)
+    s = int(sec % 60)
+    return f"{m}:{s:02d}"
+
+
+def toc_segment_count(duration: float) -> int:
+    """Сколько пунктов оглавления для видео длиной duration секунд."""
+    return max(TOC_SEGMENTS, min(TOC_MAX_SEGMENTS, math.ceil(duration / TOC_SECONDS_PER_SEGMENT)))
+
+
+def toc_segments(snippets: list[tuple[float, str]], count: int | None = None) -> list[tuple[float, str]]:
+    """Разбить сниппеты на отрезки (start_sec, текст отрезка) за один проход.
+    Границы — у равномерных отметок от первой реплики до конца, сдвинутые на самую длинную паузу между сниппетами
+    рядом с отметкой (поиск окна — bisect по массиву start). Пустых отрезков не бывает: если у отметки нет речи,
+    граница пропускается; отрезок короче половины пункта тоже не делаем — граница, уехавшая на паузу за окном,
+    не даёт следующей отметке поставить ещё одну сразу за ней."""
+    if not snippets:
+        return []
+    starts = [start for start, _ in snippets]
+    n = len(starts)
+    avg_gap = (starts[-1] - starts[0]) / (n - 1) if n > 1 else 30.0
+    origin, end = starts[0], starts[-1] + avg_gap
+    count = min(count or toc_segment_count(end - origin), n)
+    seg_len = (end - origin) / count
+    window = seg_len * TOC_SNAP
+    min_len = seg_len / 2
+    # Последняя граница — не ближе min_len к концу
+    last = bisect.bisect_right(starts, end - min_len) - 1
+    bounds = [0]
+    for k in range(1, count):
+        target = origin + k * seg_len
+        # Индекс i — граница между сниппетами i-1 и i; берём все паузы, задевающие окно
+        lo = max(
+            bisect.bisect_left(starts, target - window),
+            bisect.bisect_left(starts, starts[bounds[-1]] + min_len),
+            bounds[-1] + 1,
+        )
+        hi = min(bisect.bisect_right(starts, target + window), last, n - 1)
+        if lo > hi:
+            continue
+        # При равных паузах (ровные авто-субтитры) — ближайшая к отметке, а не первая в окне
+        bounds.append(max(range(lo, hi + 1), key=lambda i: (starts[i] - starts[i - 1], -abs(starts[i] - target))))
+    bounds.append(n)
+    return [(starts[a], " ".join(text for _, text in snippets[a:b])) for a, b in zip(bounds, bounds[1:])]
+
+
+def format_toc(segments: list[tuple[float, str]], descriptions: list[str], video_id: str) -> str:
+    """HTML-оглавление: строка «м:сс — описание» со ссылкой на этот момент видео."""
+    toc_lines = []
+    for (start_sec, _), desc in zip(segments, descriptions):
+        url = f"https://www.youtube.com/watch?v={video_id}&t={int(start_sec)}"
+        label = f"{sec_to_mmss(start_sec)} — {desc}"
+        toc_lines.append(f'<a href="{html.escape(url)}">{html.escape(label)}</a>')
+    return "\n".join(toc_lines)
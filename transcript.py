@@ -1,12 +1,33 @@
 #!/usr/bin/env python3
 """Общая логика получения транскрипта YouTube: прокси и один запрос по video_id."""
+import asyncio
+import contextvars
+import copy
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from requests import Session
 from requests.adapters import HTTPAdapter
 from requests.exceptions import ProxyError, ConnectTimeout, ReadTimeout
-from youtube_transcript_api import YouTubeTranscriptApi
+from youtube_transcript_api import (
+    InvalidVideoId,
+    NoTranscriptFound,
+    PoTokenRequired,
+    Transcript,
+    TranscriptList,
+    TranscriptsDisabled,
+    VideoUnavailable,
+    YouTubeTranscriptApi,
+)
+
+from cache import get_transcript_cache
+from corpus import index_transcript
+from metrics import Gauge, proxy_failures, route_label, transcript_fetch_seconds
+from proxy_pool import ProxyPool
 
 
 class TimeoutAdapter(HTTPAdapter):
@@ -23,7 +44,7 @@ PROXY_LIST_FILE = Path(__file__).parent / "proxies_working_list.txt"
 log = logging.getLogger(__name__)
 
 
-def _get_proxy_list() -> list[str]:
+def get_proxy_list() -> list[str]:
     """Список прокси для YouTube: YOUTUBE_PROXY (через запятую/новую строку) → proxies_working_list.txt → proxy_working.txt."""
     raw = os.environ.get("YOUTUBE_PROXY", "").strip()
     if raw:
@@ -41,60 +62,300 @@ def _get_proxy_list() -> list[str]:
     return []
 
 
+# Один пул на процесс: помнит, какие прокси живые, и сам перечитывает get_proxy_list
+proxy_pool = ProxyPool(get_proxy_list)
+
 TRANSCRIPT_TIMEOUT = 12  # секунд на один запрос (прокси или прямой)
+# Сколько загрузок транскрипта одновременно на процесс (отдельный пул потоков, не дефолтный)
+TRANSCRIPT_CONCURRENCY = int(os.environ.get("TRANSCRIPT_CONCURRENCY", "8"))
+# Хеджирование: через сколько секунд без ответа запускать параллельную попытку и сколько попыток сразу
+HEDGE_DELAY = float(os.environ.get("TRANSCRIPT_HEDGE_DELAY", "2.5"))
+HEDGE_FANOUT = max(1, int(os.environ.get("TRANSCRIPT_HEDGE_FANOUT", "3")))
+# Проигравшие попытки дорабатывают в своих потоках (list+fetch — до 2×TRANSCRIPT_TIMEOUT), поэтому пул с запасом,
+# а лишнюю попытку запускаем, только пока свободных потоков больше, чем нужно первым попыткам всех загрузок
+_HEDGE_WORKERS = 2 * HEDGE_FANOUT * TRANSCRIPT_CONCURRENCY
+_hedge_executor = ThreadPoolExecutor(max_workers=_HEDGE_WORKERS, thread_name_prefix="transcript-hedge")
+_attempts_running = 0  # отправленные в пул и не закончившиеся, включая брошенные
+_attempts_lock = threading.Lock()
+Gauge("transcript_attempts_running", "Попытки загрузки субтитров в потоках, включая брошенные", lambda: _attempts_running)
+_transcript_executor = ThreadPoolExecutor(max_workers=TRANSCRIPT_CONCURRENCY, thread_name_prefix="transcript")
+
+# Сессии живут весь процесс (по одной на маршрут): keep-alive соединения к YouTube/прокси не рвутся
+_sessions: dict[str | None, Session] = {}
+_sessions_lock = threading.Lock()
 
-def _session_with_proxy(px: str) -> Session:
+
+def _new_session() -> Session:
     s = Session()
-    s.mount("http://", TimeoutAdapter(TRANSCRIPT_TIMEOUT))
-    s.mount("https://", TimeoutAdapter(TRANSCRIPT_TIMEOUT))
-    s.proxies["http"] = s.proxies["https"] = px
+    adapter = TimeoutAdapter(TRANSCRIPT_TIMEOUT, pool_connections=4, pool_maxsize=TRANSCRIPT_CONCURRENCY)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
     return s
 
 
-def _fetch_with_client(api: YouTubeTranscriptApi, video_id: str):
-    t = api.fetch(video_id, languages=("ru", "en"))
-    return t
+def session_for(px: str | None) -> Session:
+    """Общая сессия для прокси px (None — напрямую)."""
+    with _sessions_lock:
+        s = _sessions.get(px)
+        if s is None:
+            s = _new_session()
+            if px is not None:
+                s.proxies["http"] = s.proxies["https"] = px
+            _sessions[px] = s
+        return s
 
 
-def fetch_transcript(video_id: str) -> tuple[str | None, str | None]:
-    """Текст транскрипта. Перебирает список прокси, при неудаче — без прокси."""
-    proxies = _get_proxy_list()
-    for px in proxies:
+# Языки субтитров по убыванию предпочтения; на первый из них переводим, если нет ни одного
+TRANSCRIPT_LANGUAGES = tuple(
+    x.strip() for x in os.environ.get("TRANSCRIPT_LANGUAGES", "ru,en").split(",") if x.strip()
+) or ("ru", "en")
+# Список дорожек видео (страница + innertube — два запроса) помним в памяти: повторные попытки
+# через другие прокси и повторные запросы того же видео сразу качают выбранную дорожку
+TRACK_LIST_TTL = float(os.environ.get("TRACK_LIST_TTL_SEC", "600"))
+TRACK_LIST_MAX = 1000
+_track_lists: OrderedDict[str, tuple[float, TranscriptList]] = OrderedDict()
+_track_lists_lock = threading.Lock()
+
+
+def _cached_track_list(video_id: str) -> TranscriptList | None:
+    now = time.monotonic()
+    with _track_lists_lock:
+        item = _track_lists.get(video_id)
+        if item is None:
+            return None
+        if item[0] < now:
+            del _track_lists[video_id]
+            return None
+        _track_lists.move_to_end(video_id)
+        return item[1]
+
+
+def _store_track_list(video_id: str, listing: TranscriptList) -> None:
+    with _track_lists_lock:
+        _track_lists[video_id] = (time.monotonic() + TRACK_LIST_TTL, listing)
+        _track_lists.move_to_end(video_id)
+        while len(_track_lists) > TRACK_LIST_MAX:
+            _track_lists.popitem(last=False)
+
+
+def _drop_track_list(video_id: str) -> None:
+    with _track_lists_lock:
+        _track_lists.pop(video_id, None)
+
+
+def choose_tracks(listing: TranscriptList, languages=TRANSCRIPT_LANGUAGES) -> list[Transcript]:
+    """Дорожки в порядке, в котором их пробовать: ручные на нужных языках, автосубтитры на нужных языках,
+    перевод на нужный язык, в конце — любая исходная дорожка (LLM поймёт и её)."""
+    tracks = list(listing)
+    manual = [t for t in tracks if not t.is_generated]
+    generated = [t for t in tracks if t.is_generated]
+    out: list[Transcript] = []
+    for group in (manual, generated):
+        for lang in languages:
+            out.extend(t for t in group if t.language_code == lang)
+    for lang in languages:
+        source = next((t for t in manual + generated if any(x.language_code == lang for x in t.translation_languages)), None)
+        if source is not None and source.language_code != lang:
+            out.append(source.translate(lang))
+    rest = [t for t in manual + generated if t not in out]
+    return out + rest[:1]
+
+
+def fetch_with_client(api: YouTubeTranscriptApi, video_id: str):
+    """Скачать лучшую дорожку через маршрут api. Список дорожек — из кэша или одним запросом через этот маршрут.
+    Дорожка, которой нужен PoToken (он привязан к ссылке дорожки), или отказ по самому видео — пробуем следующую;
+    прочие ошибки — вина маршрута, их пробрасываем. Не отдалась ни одна — последняя ошибка (PoToken — тоже вина
+    маршрута: через другой список может прийти без него)."""
+    listing = _cached_track_list(video_id)
+    # Дорожку из кэша качаем через текущий маршрут, подменяя её сессию — это приватные поля youtube_transcript_api;
+    # если в установленной версии их нет, список запрашиваем заново
+    client = getattr(getattr(api, "_fetcher", None), "_http_client", None)
+    if listing is not None and (client is None or not all(hasattr(t, "_http_client") for t in listing)):
+        listing = None
+    from_cache = listing is not None
+    if listing is None:
+        listing = api.list(video_id)
+        _store_track_list(video_id, listing)
+    tracks = choose_tracks(listing)
+    if not tracks:
+        raise NoTranscriptFound(video_id, TRANSCRIPT_LANGUAGES, listing)
+    last_err: Exception | None = None
+    for track in tracks:
+        if from_cache:
+            # Дорожка из кэша привязана к сессии маршрута, который её нашёл, — качаем через текущий
+            track = copy.copy(track)
+            track._http_client = client
         try:
-            client = _session_with_proxy(px)
-            api = YouTubeTranscriptApi(http_client=client)
-            t = _fetch_with_client(api, video_id)
-            return " ".join(s.text for s in t.snippets), None
+            return track.fetch()
+        except PoTokenRequired as e:
+            last_err = e
         except Exception as e:
-            log.warning("fetch_transcript %s proxy %s: %s", video_id, px, type(e).__name__)
+            if is_proxy_fault(e):
+                if from_cache:
+                    _drop_track_list(video_id)  # ссылки в списке могли протухнуть
+                raise
+            last_err = e
+    raise last_err
+
+
+# Ответы про само видео — через любой маршрут будет то же самое. Всё остальное (блокировка, сеть,
+# подменённая прокси страница — YouTubeDataUnparsable, гео-блок, consent-cookie в ЕС) зависит от маршрута
+_VIDEO_ERRORS = (TranscriptsDisabled, NoTranscriptFound, VideoUnavailable, InvalidVideoId)
+
+
+def is_proxy_fault(e: Exception) -> bool:
+    """Вина маршрута (прокси или прямого соединения): пробуем дальше. Нет — у видео правда нет субтитров."""
+    return not isinstance(e, _VIDEO_ERRORS)
+
+
+def _route(px: str | None) -> str:
+    """Метка маршрута для метрик: свои прокси — поимённо, веб-прокси (меняются каждые полчаса) — одной меткой web,
+    иначе серии по каждому когда-то виденному прокси копились бы в памяти."""
+    if px is None or proxy_pool.is_configured(px):
+        return route_label(px)
+    return "web"
+
+
+def _attempt_done(_future) -> None:
+    global _attempts_running
+    with _attempts_lock:
+        _attempts_running -= 1
+
+
+def _can_hedge() -> bool:
+    """Есть поток для лишней попытки, не отнимая его у первых попыток других загрузок."""
+    with _attempts_lock:
+        return _attempts_running + TRANSCRIPT_CONCURRENCY < _HEDGE_WORKERS
+
+
+def _attempt(video_id: str, px: str | None, stop: threading.Event):
+    """Одна попытка через прокси px (None — напрямую). Вернуть (px, транскрипт или None, ошибка или None)."""
+    if stop.is_set():
+        return px, None, None
+    started = time.monotonic()
     try:
-        s = Session()
-        s.mount("http://", TimeoutAdapter(TRANSCRIPT_TIMEOUT))
-        s.mount("https://", TimeoutAdapter(TRANSCRIPT_TIMEOUT))
-        api = YouTubeTranscriptApi(http_client=s)
-        t = _fetch_with_client(api, video_id)
-        return " ".join(s.text for s in t.snippets), None
+        t = fetch_with_client(YouTubeTranscriptApi(http_client=session_for(px)), video_id)
     except Exception as e:
-        return None, f"{type(e).__name__}: {e}"
+        # Ошибки брошенных попыток (победил другой маршрут) прокси не засчитываем
+        if not stop.is_set():
+            fault = is_proxy_fault(e)
+            transcript_fetch_seconds.observe(time.monotonic() - started, route=_route(px), outcome="blocked" if fault else "no_transcript")
+            if fault:
+                proxy_failures.inc(route=_route(px))
+        if px is not None and not stop.is_set():
+            if is_proxy_fault(e):
+                proxy_pool.report_failure(px)
+            else:
+                proxy_pool.report_success(px, time.monotonic() - started)
+        if not stop.is_set():
+            log.warning("fetch_transcript %s proxy %s: %s", video_id, px or "direct", type(e).__name__)
+        return px, None, e
+    transcript_fetch_seconds.observe(time.monotonic() - started, route=_route(px), outcome="ok")
+    if px is not None:
+        proxy_pool.report_success(px, time.monotonic() - started)
+    return px, t, None
 
 
-def fetch_transcript_timestamped(video_id: str) -> tuple[list[tuple[float, str]] | None, str | None]:
-    """Транскрипт с таймкодами. Перебирает прокси, затем без прокси."""
-    proxies = _get_proxy_list()
-    for px in proxies:
-        try:
-            client = _session_with_proxy(px)
-            api = YouTubeTranscriptApi(http_client=client)
-            t = _fetch_with_client(api, video_id)
-            return [(s.start, s.text) for s in t.snippets], None
-        except Exception as e:
-            log.warning("fetch_transcript_timestamped %s proxy %s: %s", video_id, px, type(e).__name__)
+def _fetch_uncached(video_id: str) -> tuple[list[tuple[float, str]] | None, str | None, str | None]:
+    """(сниппеты, язык, ошибка). Хеджирование: стартуем с лучшего прокси пула, каждые HEDGE_DELAY сек
+    без ответа добавляем ещё попытку (следующий прокси, в конце — напрямую), но не больше HEDGE_FANOUT сразу.
+    Первый успех выигрывает: не начатые попытки отменяются, идущие дорабатывают вхолостую в своих потоках
+    (сессии общие, закрывать их нельзя) и считаются занятыми: пока потоков не хватает, лишних попыток не добавляем,
+    идём по маршрутам по одному. HEDGE_FANOUT=1 — старый последовательный перебор."""
+    routes: list[str | None] = [*proxy_pool.candidates(), None]
+    stop = threading.Event()
+    pending: set = set()
+    last_err: Exception | None = None
+    next_route = 0
+
+    def launch() -> None:
+        global _attempts_running
+        nonlocal next_route
+        px = routes[next_route]
+        next_route += 1
+        with _attempts_lock:
+            _attempts_running += 1
+        # Контекст (trace ID) — в поток попытки, чтобы её строки лога относились к запросу
+        future = _hedge_executor.submit(contextvars.copy_context().run, _attempt, video_id, px, stop)
+        future.add_done_callback(_attempt_done)  # и для отменённой до старта
+        pending.add(future)
+
+    def cancel_rest() -> None:
+        stop.set()
+        for f in pending:
+            f.cancel()
+
+    launch()
     try:
-        s = Session()
-        s.mount("http://", TimeoutAdapter(TRANSCRIPT_TIMEOUT))
-        s.mount("https://", TimeoutAdapter(TRANSCRIPT_TIMEOUT))
-        api = YouTubeTranscriptApi(http_client=s)
-        t = _fetch_with_client(api, video_id)
-        return [(sn.start, sn.text) for sn in t.snippets], None
-    except Exception as e:
-        return None, f"{type(e).__name__}: {e}"
+        while pending:
+            can_hedge = next_route < len(routes) and len(pending) < HEDGE_FANOUT
+            done, _ = wait(pending, timeout=HEDGE_DELAY if can_hedge else None, return_when=FIRST_COMPLETED)
+            if not done:
+                # Нет свободного потока — ждём текущую попытку дальше, проверим снова через HEDGE_DELAY
+                if _can_hedge():
+                    launch()
+                continue
+            for f in done:
+                pending.discard(f)
+                px, t, err = f.result()
+                if t is not None:
+                    return [(sn.start, sn.text) for sn in t.snippets], t.language_code, None
+                last_err = err
+                if not is_proxy_fault(err):
+                    # У видео нет субтитров — через другие прокси будет то же самое; запомним ненадолго
+                    reason = f"{type(err).__name__}: {err}"
+                    get_transcript_cache().put_missing(video_id, reason)
+                    return None, None, reason
+            # Провалившиеся попытки сразу заменяем следующими маршрутами
+            while next_route < len(routes) and len(pending) < HEDGE_FANOUT and (not pending or _can_hedge()):
+                launch()
+    finally:
+        cancel_rest()
+    return None, None, f"{type(last_err).__name__}: {last_err}"
+
+
+def fetch_transcript_timestamped(video_id: str) -> tuple[list[tuple[float, str]] | None, str | None]:
+    """Транскрипт с таймкодами. Сначала дисковый кэш (и «субтитров нет»), затем прокси и без прокси."""
+    hit = _from_cache(video_id)
+    if hit is not None:
+        return hit
+    return _fetch_and_store(video_id)
+
+
+def _from_cache(video_id: str) -> tuple[list[tuple[float, str]] | None, str | None] | None:
+    """(сниппеты, None) или (None, «субтитров нет») из кэша; None — надо качать."""
+    cache = get_transcript_cache()
+    cached = cache.get(video_id)
+    if cached is not None:
+        return cached[0], None
+    missing = cache.get_missing(video_id)
+    if missing is not None:
+        return None, missing
+    return None
+
+
+def _fetch_and_store(video_id: str) -> tuple[list[tuple[float, str]] | None, str | None]:
+    snippets, language, err = _fetch_uncached(video_id)
+    if snippets:
+        get_transcript_cache().put(video_id, snippets, language)
+        index_transcript(video_id, snippets)
+    return snippets, err
+
+
+def fetch_transcript(video_id: str) -> tuple[str | None, str | None]:
+    """Текст транскрипта (через тот же кэш, что и fetch_transcript_timestamped)."""
+    snippets, err = fetch_transcript_timestamped(video_id)
+    if not snippets:
+        return None, err
+    return " ".join(text for _, text in snippets), None
+
+
+async def fetch_transcript_timestamped_async(video_id: str) -> tuple[list[tuple[float, str]] | None, str | None]:
+    """То же для asyncio. Чтение кэша — тоже в потоке: оно ждёт лок и запись accessed_at (база общая с воркерами)
+    и распаковывает весь транскрипт. youtube_transcript_api синхронный (requests), поэтому загрузка — в своём
+    ограниченном пуле, отдельно от чтений кэша."""
+    hit = await asyncio.to_thread(_from_cache, video_id)
+    if hit is not None:
+        return hit
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_transcript_executor, contextvars.copy_context().run, _fetch_and_store, video_id)
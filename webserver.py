@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Маленький HTTP-сервер на asyncio (без потоков): /health, вебхук Telegram и всё, что зарегистрируют через route()."""
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+
+MAX_BODY = 4 * 1024 * 1024  # апдейт Telegram — килобайты; больше — не наш клиент
+READ_TIMEOUT = 30.0
+
+log = logging.getLogger(__name__)
+
+# (заголовки в нижнем регистре, тело) → (статус, content-type, тело ответа)
+Handler = Callable[[dict[str, str], bytes], Awaitable[tuple[int, str, bytes]]]
+
+_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class WebServer:
+    """HTTP/1.1 с keep-alive, маршрут — точное совпадение (метод, путь без query)."""
+
+    def __init__(self) -> None:
+        self._routes: dict[tuple[str, str], Handler] = {}
+        self._server: asyncio.base_events.Server | None = None
+
+    def route(self, method: str, path: str, handler: Handler) -> None:
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self, port: int, host: str = "0.0.0.0") -> None:
+        self._server = await asyncio.start_server(self._serve, host, port)
+        log.info("webserver: слушаю %s:%d (%s)", host, port, ", ".join(f"{m} {p}" for m, p in self._routes))
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    await self._respond(writer, 400, "text/plain", b"bad request", close=True)
+                    break
+                method, target, version = parts
+                headers: dict[str, str] = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0") or 0)
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, "text/plain", b"too large", close=True)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT) if length else b""
+                close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+                status, ctype, payload = await self._dispatch(method.upper(), target.split("?", 1)[0], headers, body)
+                await self._respond(writer, status, ctype, payload if method.upper() != "HEAD" else b"", close=close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, headers: dict[str, str], body: bytes) -> tuple[int, str, bytes]:
+        handler = self._routes.get((method, path)) or (method == "HEAD" and self._routes.get(("GET", path)))
+        if not handler:
+            if any(p == path for _, p in self._routes):
+                return 405, "text/plain", b"method not allowed"
+            return 404, "text/plain", b"not found"
+        try:
+            return await handler(headers, body)
+        except Exception as e:
+            log.exception("webserver %s %s: %s", method, path, type(e).__name__)
+            return 500, "text/plain", b"error"
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, ctype: str, payload: bytes, close: bool = False) -> None:
+        head = (
+            f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Воркер очереди: забирает задачи из jobqueue (их кладёт bot.py при JOB_QUEUE=1), качает субтитры, зовёт LLM
+и отвечает в чат через Bot API. Процессов — сколько ядер дадим (--processes), в каждом до WORKER_CONCURRENCY задач.
+Процессы делят JOBS_DB/CACHE_DB с ботом — только на одной машине: SQLite WAL не работает через сетевой диск,
+а volume Fly.io подключается к одной машине. Задачи не задваиваются."""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+from telegram import Bot
+from telegram.error import TelegramError
+
+from jobqueue import HEARTBEAT_EVERY, Job, JobQueue
+from metrics import install_trace_logging, metrics_handler, new_trace
+from pipeline import process_video, warm_up
+from webserver import WebServer
+
+# Сколько задач один процесс ведёт одновременно (почти всё время — ожидание YouTube/OpenAI)
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "16"))
+# /metrics воркера: процесс с номером i слушает WORKER_METRICS_PORT + i (не задан — без HTTP)
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", "0"))
+POLL_INTERVAL = 0.5
+STALE_CHECK_EVERY = 60.0
+PURGE_EVERY = 3600.0
+FAILED_TEXT = "Не получилось обработать видео. Попробуй ещё раз позже."
+
+log = logging.getLogger(__name__)
+
+
+def _reply_for(bot: Bot, job: Job):
+    """reply(text, parse_mode) для pipeline: новое сообщение в чат ответом на исходное."""
+    async def reply(text: str, parse_mode: str | None = None):
+        return await bot.send_message(
+            job.chat_id, text, parse_mode=parse_mode,
+            reply_to_message_id=job.reply_to, allow_sending_without_reply=True,
+        )
+    return reply
+
+
+async def _heartbeat(queue: JobQueue, job: Job, worker: str) -> None:
+    """Пока задача идёт — отмечаемся, чтобы requeue_stale не отдал её другому воркеру (длинный map-reduce)."""
+    while True:
+        await asyncio.sleep(HEARTBEAT_EVERY)
+        if not await asyncio.to_thread(queue.heartbeat, job.id, worker):
+            log.warning("job %d: задачу у нас забрали", job.id)
+            return
+
+
+async def _run_job(bot: Bot, queue: JobQueue, job: Job, worker: str) -> None:
+    new_trace()
+    log.info("job %d: %s %s (%d абз.), попытка %d", job.id, job.video_id, job.mode, job.paragraphs, job.attempts)
+    heartbeat = asyncio.create_task(_heartbeat(queue, job, worker))
+    error = None
+    try:
+        await process_video(_reply_for(bot, job), job.video_id, job.mode, job.paragraphs)
+    except Exception as e:
+        log.exception("job %d: %s", job.id, type(e).__name__)
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        heartbeat.cancel()
+    if not await asyncio.to_thread(queue.finish, job.id, worker, error):
+        log.warning("job %d: закрыта не нами (вернули в очередь по таймауту)", job.id)
+    elif error:
+        await _notify_failed(bot, job)
+
+
+async def _notify_failed(bot: Bot, job: Job) -> None:
+    """Задача закрыта с ошибкой и больше не повторится — сказать пользователю, а не молчать."""
+    try:
+        await _reply_for(bot, job)(FAILED_TEXT)
+    except TelegramError as e:
+        log.warning("job %d: не смог сообщить об ошибке: %s", job.id, type(e).__name__)
+
+
+async def serve(name: str, index: int = 0) -> None:
+    token = os.environ.get("TELEGRAM_BOT_TOKEN")
+    if not token:
+        raise SystemExit("Задай TELEGRAM_BOT_TOKEN в окружении.")
+    queue = JobQueue()
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    running: set[asyncio.Task] = set()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    web = WebServer()
+    if WORKER_METRICS_PORT:
+        web.route("GET", "/metrics", metrics_handler)
+        await web.start(WORKER_METRICS_PORT + index)
+
+    await warm_up()
+    async with Bot(token) as bot:
+        log.info("%s: готов, до %d задач одновременно", name, WORKER_CONCURRENCY)
+        last_stale_check = last_purge = float("-inf")
+        while not stop.is_set():
+            if loop.time() - last_stale_check > STALE_CHECK_EVERY:
+                last_stale_check = loop.time()
+                n, failed = await asyncio.to_thread(queue.requeue_stale)
+                if n:
+                    log.warning("%s: вернул в очередь %d зависших задач", name, n)
+                for job in failed:
+                    log.warning("job %d: зависла %d раз, закрыта", job.id, job.attempts)
+                    await _notify_failed(bot, job)
+            if loop.time() - last_purge > PURGE_EVERY:
+                last_purge = loop.time()
+                if n := await asyncio.to_thread(queue.purge):
+                    log.info("%s: удалил %d старых задач", name, n)
+            await slots.acquire()
+            job = await asyncio.to_thread(queue.claim, name)
+            if job is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(stop.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(_run_job(bot, queue, job, name))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+        # Начатые задачи доводим до конца: иначе их через JOB_STALE_SEC повторит другой воркер
+        if running:
+            log.info("%s: дожидаюсь %d задач", name, len(running))
+            await asyncio.gather(*running, return_exceptions=True)
+    await web.stop()
+
+
+def _process_main(index: int) -> None:
+    install_trace_logging()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s")
+    asyncio.run(serve(f"{socket.gethostname()}:{os.getpid()}:{index}", index))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--processes", type=int, default=int(os.environ.get("WORKER_PROCESSES", "1")),
+                        help="сколько процессов-воркеров запустить (0 — по числу ядер)")
+    args = parser.parse_args()
+    n = args.processes or os.cpu_count() or 1
+    if n == 1:
+        _process_main(0)
+        return
+    procs = [multiprocessing.Process(target=_process_main, args=(i,), name=f"worker-{i}") for i in range(n)]
+    for p in procs:
+        p.start()
+    # Ctrl+C получают все процессы группы; SIGTERM (docker stop) пересылаем сами. Каждый дорабатывает свои задачи
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: [p.terminate() for p in procs if p.is_alive()])
+    for p in procs:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()